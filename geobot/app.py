@@ -1,14 +1,24 @@
 from aiogram import executor
 from aiogram.dispatcher.filters import Command
+from aiohttp import web
+from scripts.building_info_scripts import CardRenderCache, carousel_cb
 from scripts.handlers_funcs import (back_from_street_search, chat,
                                     get_live_geo, get_location,
-                                    handle_any_location, handle_start,
+                                    handle_any_location,
+                                    handle_outdated_carousel, handle_start,
                                     handle_street_search_button, mailing,
                                     refresh_buildings_info,
                                     save_builing_message, search_geo_by_street,
-                                    send_geo, show_next_building,
-                                    show_previous_building, show_stats)
-from utils.utils import UserStates, dp, on_shutdown, on_startup
+                                    send_geo, show_building, show_stats)
+from utils.router import WorkerPool, create_router_app
+from utils.spatial_index import BuildingsIndex
+from utils.utils import (BOT_MODE, WEBAPP_HOST, WEBAPP_PORT,
+                         WEBHOOK_CONCURRENCY, WEBHOOK_PATH, WEBHOOK_SECRET,
+                         WORKERS, UserStates, dp, on_shutdown, on_startup,
+                         on_webhook_startup)
+from utils.webhook import LimitedWebhookRequestHandler, create_web_app
+
+BuildingsIndex().add_listener(CardRenderCache().invalidate)
 
 dp.message_handler(Command("start"))(handle_start)
 dp.message_handler(Command("mailing_message"))(mailing)
@@ -23,12 +33,30 @@ dp.message_handler(state=UserStates.street_search)(search_geo_by_street)
 dp.message_handler(content_types=["location"])(get_location)
 dp.message_handler(content_types=["photo", "text", "video_note", "voice"])(chat)
 
-dp.callback_query_handler(text="show_next_building")(show_next_building)
+dp.callback_query_handler(carousel_cb.filter(action="show"))(show_building)
 dp.callback_query_handler(text="back_from_street_search", state=UserStates.street_search)(back_from_street_search)
 dp.callback_query_handler(text="send_geo")(send_geo)
-dp.callback_query_handler(text="show_previous_building")(show_previous_building)
-dp.callback_query_handler(text="save")(save_builing_message)
+dp.callback_query_handler(carousel_cb.filter(action="save"))(save_builing_message)
+dp.callback_query_handler(text=["show_next_building", "show_previous_building", "save"])(handle_outdated_carousel)
 
 
 if __name__ == "__main__":
-    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    if BOT_MODE == "cluster":
+        pool = WorkerPool(WORKERS, "127.0.0.1", WEBAPP_PORT + 1)
+        web.run_app(
+            create_router_app(pool, WEBHOOK_PATH, WEBHOOK_SECRET),
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT,
+        )
+    elif BOT_MODE == "webhook":
+        webhook_executor = executor.Executor(dp)
+        webhook_executor.on_startup([on_startup, on_webhook_startup])
+        webhook_executor.on_shutdown(on_shutdown)
+        webhook_executor.set_webhook(
+            WEBHOOK_PATH,
+            request_handler=LimitedWebhookRequestHandler,
+            web_app=create_web_app(WEBHOOK_CONCURRENCY, WEBHOOK_SECRET),
+        )
+        webhook_executor.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT, reuse_port=True)
+    else:
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1 @@
+# Lets pytest import the bot modules (utils, scripts) from any working directory.
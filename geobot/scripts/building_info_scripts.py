@@ -1,9 +1,19 @@
+from typing import Optional
+
 import aiogram
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from aiogram.utils.callback_data import CallbackData
 from motor.motor_asyncio import AsyncIOMotorClient
 from scripts.from_notion import increment_views_counter
-from utils.db import MongoDB
-from utils.utils import DYNAMIC_RADIUS, STATIC_RADIUS
+from utils.db import MongoDB, SingletonMeta
+from utils.photo_cache import PhotoCache
+from utils.spatial_index import BuildingsIndex
+from utils.utils import (CLOSEST_BUILDINGS_LIMIT, DYNAMIC_RADIUS,
+                         MAX_CAROUSELS, STATIC_RADIUS)
+
+CARD_PROJECTION = {"_id": 0, "id": 1, "name": 1, "image": 1, "link": 1}
+
+carousel_cb = CallbackData("carousel", "action", "session", "index")
 
 
 async def handle_location(
@@ -12,6 +22,7 @@ async def handle_location(
     lat_user: float,
     lon_user: float,
     live=False,
+    closest_buildings: Optional[list] = None,
 ):
     if live:
         start_point = await state.get_data()
@@ -23,9 +34,8 @@ async def handle_location(
         previous_link = None
 
     radius = STATIC_RADIUS if not live else DYNAMIC_RADIUS
-    closest_buildings = await get_closest_buildings(
-        lat_user, lon_user, radius, message_to_reply
-    )
+    if closest_buildings is None:
+        closest_buildings = await get_closest_buildings(lat_user, lon_user, radius)
 
     if not closest_buildings:
         if live:
@@ -36,250 +46,348 @@ async def handle_location(
             )
             return
 
-    await state.update_data(
-        {
-            message.from_user.id: closest_buildings,
-            "user_start_point": [lat_user, lon_user],
-        }
-    )
+    building = closest_buildings[0]
+    if live and previous_link == building["link"]:
+        return
 
-    name, distance, photo, link, text, item_id = get_building_properties(
-        closest_buildings, index=0
+    session = await store_carousel(
+        state,
+        create_buildings_cursor(closest_buildings, lat_user, lon_user, message_to_reply),
+    )
+    choice_menu = await CardRenderCache().keyboard(
+        building, 0, len(closest_buildings), session
     )
-    choice_menu = create_keyboard(closest_buildings, 0, link)
 
     if live:
-        await handle_live_location(
-            message,
-            state,
-            previous_link,
-            link,
-            name,
-            distance,
-            photo,
-            text,
-            item_id,
-            choice_menu,
-        )
+        await handle_live_location(message, state, building, choice_menu)
     else:
-        await handle_static_location(
-            message, name, distance, photo, text, item_id, choice_menu
-        )
+        await handle_static_location(message, building, choice_menu)
 
 
 async def handle_no_closest_building(
     message, lat_user, lon_user, message_to_reply, radius
 ):
-    closest_buildings = await get_closest_buildings(
-        lat_user, lon_user, 20004, message_to_reply
-    )
-    distance = closest_buildings[0]["distance"]
+    distance = await get_closest_building_distance(lat_user, lon_user)
+    nearest_text = f" До ближайшего {round(distance)} км" if distance is not None else ""
     await message.reply(
-        text=f"В радиусе {round((radius)*1000)} метров нет зданий! До ближайшего {round(distance)} км\n\nЖмите на кнопки!"
+        text=f"В радиусе {round((radius)*1000)} метров нет зданий!{nearest_text}\n\nЖмите на кнопки!"
     )
 
 
-async def handle_live_location(
-    message,
-    state,
-    previous_link,
-    link,
-    name,
-    distance,
-    photo,
-    text,
-    item_id,
-    choice_menu,
-):
-    if previous_link != link:
-        views = await increment_views_counter(item_id)
-        answer = f"<b>{name}</b>\n\n{text}\n\n{int(round(distance, 2) * 1000)} метров\n{views} 👀"
-        sent_message = await message.reply_photo(
+async def handle_live_location(message, state, building, choice_menu):
+    views = await increment_views_counter(building["id"])
+    answer = await CardRenderCache().caption(building, views)
+    await PhotoCache().send(
+        building["id"],
+        building["image"],
+        lambda photo: message.reply_photo(
             photo, answer, reply_markup=choice_menu, parse_mode=ParseMode.HTML
-        )
-        previous_url = sent_message.reply_markup.inline_keyboard[0][0]["url"]
-        await state.update_data({"previous_link": previous_url})
-
+        ),
+    )
+    await state.update_data({"previous_link": building["link"]})
 
-async def handle_static_location(
-    message, name, distance, photo, text, item_id, choice_menu
-):
-    views = await increment_views_counter(item_id)
 
-    answer = (
-        f"<b>{name}</b>\n\n{text}\n\n{int(round(distance, 2) * 1000)} метров\n{views} 👀"
-    )
-    await message.reply_photo(
-        photo, answer, reply_markup=choice_menu, parse_mode=ParseMode.HTML
+async def handle_static_location(message, building, choice_menu):
+    views = await increment_views_counter(building["id"])
+    answer = await CardRenderCache().caption(building, views)
+    await PhotoCache().send(
+        building["id"],
+        building["image"],
+        lambda photo: message.reply_photo(
+            photo, answer, reply_markup=choice_menu, parse_mode=ParseMode.HTML
+        ),
     )
 
 
 async def get_closest_buildings(
-    latitude_user: float, longitude_user: float, radius: float, message_to_reply_id: int
+    latitude_user: float,
+    longitude_user: float,
+    radius: float,
+    limit: int = CLOSEST_BUILDINGS_LIMIT,
 ) -> list[dict]:
-    radius_in_meters = radius * 1000
+    """
+    Compact page of the buildings within radius km, closest first.
 
-    pipeline = create_mongo_pipeline(latitude_user, longitude_user, radius_in_meters)
+    Only the fields needed to draw a card are fetched; the text of a building
+    is loaded on demand when its card is shown.
 
-    return await get_buildings_from_pipeline(
-        pipeline, latitude_user, longitude_user, message_to_reply_id
+    Returns:
+        list: Dictionaries created by create_building_dict.
+    """
+    index = BuildingsIndex()
+    if index.loaded:
+        return [
+            create_building_dict(building, distance)
+            for distance, building in index.query_radius(
+                latitude_user, longitude_user, radius, limit
+            )
+        ]
+
+    radius_in_meters = radius * 1000
+
+    pipeline = create_mongo_pipeline(
+        latitude_user,
+        longitude_user,
+        radius_in_meters,
+        limit=limit,
+        projection={**CARD_PROJECTION, "distance": 1},
     )
 
+    return await get_buildings_from_pipeline(pipeline)
 
-def create_mongo_pipeline(
-    latitude_user: float, longitude_user: float, radius_in_meters: float
-) -> list[dict]:
-    return [
-        {
-            "$geoNear": {
-                "near": {
-                    "type": "Point",
-                    "coordinates": [longitude_user, latitude_user],
-                },
-                "distanceField": "distance",
-                "maxDistance": radius_in_meters,
-                "includeLocs": "location",
-                "spherical": True,
-            }
-        }
-    ]
 
+async def get_closest_building_distance(
+    latitude_user: float, longitude_user: float
+) -> Optional[float]:
+    """
+    Distance in km to the single closest building, however far it is.
 
-async def get_buildings_from_pipeline(
-    pipeline: list[dict],
+    Returns:
+        float: The distance, or None if there are no buildings at all.
+    """
+    index = BuildingsIndex()
+    if index.loaded:
+        nearest = index.query_nearest(latitude_user, longitude_user, limit=1)
+        return nearest[0][0] if nearest else None
+
+    pipeline = create_mongo_pipeline(
+        latitude_user,
+        longitude_user,
+        limit=1,
+        projection={"_id": 0, "distance": 1},
+    )
+    collection = await MongoDB().get_collection("buildings_collection")
+    async for building in collection.aggregate(pipeline):
+        return building["distance"] / 1000
+
+    return None
+
+
+def create_mongo_pipeline(
     latitude_user: float,
     longitude_user: float,
-    message_to_reply_id: int,
+    radius_in_meters: Optional[float] = None,
+    limit: Optional[int] = None,
+    projection: Optional[dict] = None,
 ) -> list[dict]:
+    geo_near = {
+        "near": {
+            "type": "Point",
+            "coordinates": [longitude_user, latitude_user],
+        },
+        "distanceField": "distance",
+        "includeLocs": "location",
+        "spherical": True,
+    }
+    if radius_in_meters is not None:
+        geo_near["maxDistance"] = radius_in_meters
+
+    pipeline = [{"$geoNear": geo_near}]
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    if projection is not None:
+        pipeline.append({"$project": projection})
+
+    return pipeline
+
+
+async def get_buildings_from_pipeline(pipeline: list[dict]) -> list[dict]:
     closest_buildings = []
     collection = await MongoDB().get_collection("buildings_collection")
     async for building in collection.aggregate(pipeline):
         distance = building["distance"] / 1000
-        closest_buildings.append(
-            create_building_dict(
-                building, distance, latitude_user, longitude_user, message_to_reply_id
-            )
-        )
+        closest_buildings.append(create_building_dict(building, distance))
 
     return closest_buildings
 
 
-def create_building_dict(
-    building, distance, latitude_user, longitude_user, message_to_reply_id
-):
+def create_building_dict(building, distance):
     return {
+        "id": building["id"],
         "distance": distance,
+        "name": building["name"],
+        "image": building["image"],
+        "link": building["link"],
+    }
+
+
+def create_buildings_cursor(
+    closest_buildings, latitude_user, longitude_user, message_to_reply_id
+):
+    """
+    The compact form of a result page that is kept in the user's FSM data:
+    building ids with their distances, the start point and the message to reply to.
+    """
+    return {
+        "buildings": [
+            [building["id"], building["distance"]] for building in closest_buildings
+        ],
         "user_start_point": [latitude_user, longitude_user],
         "message_to_reply": message_to_reply_id,
-        "building_data": {
-            "id": building["id"],
-            "name": building["name"],
-            "layer": building["layer"],
-            "text": building["text"],
-            "location": building["location"],
-            "image": building["image"],
-            "link": building["link"],
-            "views": int(building["views"]),
-        },
     }
 
 
-def get_building_properties(closest_buildings: list, index: int):
+async def store_carousel(state: aiogram.dispatcher.storage.FSMContext, cursor: dict) -> str:
     """
-    Retrieve the properties of the building in the given index of closest_buildings list of dictionaries.
+    Store a new carousel cursor in the user's FSM data and return its session token.
 
-    Args:
-        closest_buildings (list): List of dictionaries, each containing information about a building.
-        index (int): Index of the building to retrieve information from.
-
-    Returns:
-        tuple: A tuple containing the building's name, distance, photo, link, text, item_id.
+    Every carousel gets its own token, so buttons of older carousels keep working
+    until the carousel is evicted by the MAX_CAROUSELS newer ones.
     """
+    user_data = await state.get_data()
+    sequence = user_data.get("carousel_seq", 0) + 1
+    carousels = user_data.get("carousels", {})
+    carousels[str(sequence)] = cursor
 
-    name = closest_buildings[index]["building_data"]["name"]
-    distance = closest_buildings[index]["distance"]
-    photo = closest_buildings[index]["building_data"]["image"]
-    link = closest_buildings[index]["building_data"]["link"]
-    text = closest_buildings[index]["building_data"]["text"]
-    item_id = closest_buildings[index]["building_data"]["id"]
-    return name, distance, photo, link, text, item_id
+    for session in sorted(carousels, key=int)[:-MAX_CAROUSELS]:
+        del carousels[session]
 
+    await state.update_data(
+        {
+            "carousels": carousels,
+            "carousel_seq": sequence,
+            "user_start_point": cursor["user_start_point"],
+        }
+    )
+    return str(sequence)
 
-def create_keyboard(
-    closest_buildings: list, index: int, link: str
-) -> InlineKeyboardMarkup:
-    """
-    Creates an InlineKeyboardMarkup object with buttons to display information about a building.
 
-    Args:
-        closest_buildings (list): List of dictionaries, each containing information about a building.
-        index (int): Index of the building to display information about.
-        link (str): URL to show more information about the building.
+async def get_carousel(
+    state: aiogram.dispatcher.storage.FSMContext, session: str
+) -> Optional[dict]:
+    user_data = await state.get_data()
+    return user_data.get("carousels", {}).get(session)
 
-    Returns:
-        InlineKeyboardMarkup: An InlineKeyboardMarkup object with buttons for the user to view more information or get directions to the building.
+
+async def get_building_from_cursor(cursor: dict, index: int) -> Optional[dict]:
     """
+    Fetch the full card of the building at the given cursor position, text included.
+    """
+    item_id, distance = cursor["buildings"][index]
 
-    choice_menu = InlineKeyboardMarkup(row_width=1)
-    street_choice = InlineKeyboardButton(
-        text="Подробнее 📖",
-        callback_data="get_link",
-        url=link,
-    )
-    get_geo = InlineKeyboardButton(text="Как дойти? 🚏", callback_data="send_geo")
-    next_building = InlineKeyboardButton(
-        text=f"Cледующее здание ⏭️",
-        callback_data="show_next_building",
-    )
-    counter = InlineKeyboardButton(
-        text=f"{index+1} из {len(closest_buildings)}", callback_data="counter"
-    )
-    previous_building = InlineKeyboardButton(
-        text="⏮️ Предыдущее здание", callback_data="show_previous_building"
-    )
-    next_building_short = InlineKeyboardButton(
-        text="⏭️", callback_data="show_next_building"
-    )
-    previous_building_short = InlineKeyboardButton(
-        text="⏮️", callback_data="show_previous_building"
-    )
+    building = BuildingsIndex().by_id.get(item_id)
+    if building is None:
+        collection = await MongoDB().get_collection("buildings_collection")
+        building = await collection.find_one(
+            {"id": item_id}, {**CARD_PROJECTION, "text": 1}
+        )
+        if building is None:
+            return None
 
-    save = InlineKeyboardButton(text="Сохранить 📥", callback_data="save")
+    return {**create_building_dict(building, distance), "text": building["text"]}
 
-    choice_menu.row(street_choice, get_geo)
 
-    if len(closest_buildings) > 1 and index != 0:
-        choice_menu.row(previous_building_short, counter)
+async def load_building_text(building: dict) -> dict:
+    indexed_building = BuildingsIndex().by_id.get(building["id"])
+    if indexed_building is not None:
+        return {**building, "text": indexed_building["text"]}
 
-    if len(closest_buildings) > 1 and index + 1 != len(closest_buildings):
-        choice_menu.row(counter, next_building_short)
+    collection = await MongoDB().get_collection("buildings_collection")
+    document = await collection.find_one({"id": building["id"]}, {"_id": 0, "text": 1})
+    return {**building, "text": document["text"] if document else ""}
 
-    if (
-        len(closest_buildings) > 1
-        and index != 0
-        and index + 1 != len(closest_buildings)
-    ):
-        choice_menu.inline_keyboard.remove([counter, next_building_short])
-        choice_menu.inline_keyboard.remove([previous_building_short, counter])
-        choice_menu.row(previous_building_short, counter, next_building_short)
 
-    choice_menu.insert(save)
+NAVIGATION_TEMPLATES = {
+    "single": (),
+    "first": ("counter", "next"),
+    "middle": ("previous", "counter", "next"),
+    "last": ("previous", "counter"),
+}
 
-    return choice_menu
 
+class CardRenderCache(metaclass=SingletonMeta):
+    """
+    Pre-rendered parts of the building cards.
 
-def create_keyboard_for_saved_message(
-    closest_buildings: list, index: int, link: str
-) -> InlineKeyboardMarkup:
-    saved_message_menu = InlineKeyboardMarkup(row_width=2)
-    street_choice = InlineKeyboardButton(
-        text="Подробнее 📖",
-        callback_data="get_link",
-        url=link,
-    )
-    get_geo = InlineKeyboardButton(text="Как дойти? 🚏", callback_data="send_geo")
-    saved_message_menu.row(street_choice, get_geo)
-    return saved_message_menu
+    The caption head (name and text) and the link button row of a building are
+    rendered the first time its card is shown and reused until the buildings
+    are reloaded. Only the distance, the views and the navigation buttons,
+    laid out by NAVIGATION_TEMPLATES, are filled in per card.
+    """
+
+    def __init__(self):
+        self.cards = {}
+
+    def invalidate(self, buildings: list):
+        self.cards = {}
+
+    async def get_card(self, building: dict) -> tuple:
+        """
+        Returns:
+            tuple: The caption head and the link button row of the building.
+        """
+        card = self.cards.get(building["id"])
+        if card is None:
+            if "text" not in building:
+                building = await load_building_text(building)
+            card = self.cards[building["id"]] = (
+                f"<b>{building['name']}</b>\n\n{building['text']}",
+                (
+                    InlineKeyboardButton(
+                        text="Подробнее 📖", callback_data="get_link", url=building["link"]
+                    ),
+                    InlineKeyboardButton(text="Как дойти? 🚏", callback_data="send_geo"),
+                ),
+            )
+        return card
+
+    async def caption(self, building: dict, views) -> str:
+        head, _ = await self.get_card(building)
+        return f"{head}\n\n{int(round(building['distance'], 2) * 1000)} метров\n{views} 👀"
+
+    async def saved_caption(self, building: dict) -> str:
+        head, _ = await self.get_card(building)
+        return head
+
+    async def keyboard(
+        self, building: dict, index: int, total: int, session: str
+    ) -> InlineKeyboardMarkup:
+        """
+        Keyboard of a carousel card: the link row, the navigation row and the save button.
+
+        Args:
+            index (int): Position of the building in the carousel.
+            total (int): Number of the buildings in the carousel.
+            session (str): Carousel token; navigation buttons carry it with the target index.
+        """
+        _, link_row = await self.get_card(building)
+
+        if total == 1:
+            template = NAVIGATION_TEMPLATES["single"]
+        elif index == 0:
+            template = NAVIGATION_TEMPLATES["first"]
+        elif index + 1 == total:
+            template = NAVIGATION_TEMPLATES["last"]
+        else:
+            template = NAVIGATION_TEMPLATES["middle"]
+
+        buttons = {
+            "previous": lambda: InlineKeyboardButton(
+                text="⏮️",
+                callback_data=carousel_cb.new(action="show", session=session, index=index - 1),
+            ),
+            "counter": lambda: InlineKeyboardButton(
+                text=f"{index + 1} из {total}", callback_data="counter"
+            ),
+            "next": lambda: InlineKeyboardButton(
+                text="⏭️",
+                callback_data=carousel_cb.new(action="show", session=session, index=index + 1),
+            ),
+        }
+        save = InlineKeyboardButton(
+            text="Сохранить 📥",
+            callback_data=carousel_cb.new(action="save", session=session, index=index),
+        )
+
+        rows = [list(link_row)]
+        if template:
+            rows.append([buttons[kind]() for kind in template])
+        rows.append([save])
+        return InlineKeyboardMarkup(inline_keyboard=rows)
+
+    async def saved_keyboard(self, building: dict) -> InlineKeyboardMarkup:
+        _, link_row = await self.get_card(building)
+        return InlineKeyboardMarkup(inline_keyboard=[list(link_row)])
 
 
 async def send_geo_by_coordinates(link: str):
@@ -1,127 +1,311 @@
+import asyncio
+import hashlib
+import json
 import logging
+from datetime import datetime, timedelta, timezone
 
-from notion_client import Client
-from pymongo import GEOSPHERE
+from notion_client import AsyncClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from utils.db import MongoDB
+from utils.spatial_index import BuildingsIndex
+from utils.usage_stats import UsageStats
 from utils.utils import NOTION_API_TOKEN, NOTION_DB
+from utils.views_counter import ViewsCounter
 
+BULK_WRITE_CHUNK_SIZE = 500
+SYNC_STATE_ID = "notion_buildings"
+SYNC_WATERMARK_OVERLAP = timedelta(minutes=2)
+FULL_SYNC_INTERVAL = timedelta(days=1)
 
-async def get_buildings_from_notion():
+
+class SyncProgress:
+    """
+    Counters of a running Notion sync, updated by the pipeline stages as
+    buildings flow through them.
     """
-    Fetches building data from a Notion database and writes it to a MongoDB collection.
 
-    Retrieves building data from the Notion database specified by the NOTION_DB constant.
-    The data includes the building's ID, name, layer, text, coordinates, image, and link.
-    The views counter is fetched from the current MongoDB collection.
-    This data is stored in a list of dictionaries.
+    def __init__(self):
+        self.fetched = 0
+        self.added = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.duplicates = 0
+        self.collapsed = {}
+        self.seen_ids = set()
+        self.removed = 0
+        self.failed_ids = []
+        self.full = False
+
+
+async def iter_notion_results(notion, query_filter=None):
     """
+    Yields the results of the NOTION_DB database one response at a time.
+
+    The next response is requested as soon as the cursor for it is known,
+    so it downloads while the current one flows through the pipeline.
+    """
+    query = {"database_id": NOTION_DB, "page_size": 100}
+    if query_filter is not None:
+        query["filter"] = query_filter
+
+    next_page = asyncio.create_task(notion.databases.query(**query))
     try:
-        notion = Client(auth=NOTION_API_TOKEN)
-    except Exception as e:
-        logging.error(f"Failed to connect to Notion: {str(e)}")
-        return
+        while next_page is not None:
+            response = await next_page
+            next_cursor = response.get("next_cursor")
+            next_page = (
+                asyncio.create_task(
+                    notion.databases.query(**query, start_cursor=next_cursor)
+                )
+                if next_cursor
+                else None
+            )
+
+            yield response.get("results", [])
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+async def get_sync_watermark():
+    """
+    Watermark of the last successful sync, or None if the next sync must be full
+    because there is none or the last full sync is older than FULL_SYNC_INTERVAL.
+    """
+    collection = await MongoDB().get_collection("sync_state")
+    sync_state = await collection.find_one({"_id": SYNC_STATE_ID})
+    if not sync_state or not sync_state.get("full_synced_at"):
+        return None
+
+    full_synced_at = datetime.fromisoformat(sync_state["full_synced_at"])
+    if datetime.now(timezone.utc) - full_synced_at > FULL_SYNC_INTERVAL:
+        return None
+    return sync_state["watermark"]
+
+
+async def save_sync_watermark(watermark, full=False):
+    fields = {"watermark": watermark}
+    if full:
+        fields["full_synced_at"] = watermark
+
+    collection = await MongoDB().get_collection("sync_state")
+    await collection.update_one({"_id": SYNC_STATE_ID}, {"$set": fields}, upsert=True)
+
+
+def parse_building(notion_data):
+    """
+    Converts a Notion page into a building dictionary.
+
+    Returns None for pages without a layer, which are not shown by the bot.
+    """
+    properties = notion_data["properties"]
+    item_id = notion_data["id"]
+
+    if properties["properties.layer"]["select"] is not None:
+        layer = properties["properties.layer"]["select"]["name"]
+    else:
+        return None
+
+    topos_id = properties["properties.topos_id"]["number"]
+    taxonomy_id = properties["properties.taxonomy_id"]["number"]
+    link = f"https://topos.memo.ru/article/{topos_id}+{taxonomy_id}"
+
+    name_property = properties["properties.name"]
+    name = (
+        name_property["rich_text"][0]["text"]["content"]
+        if "rich_text" in name_property and name_property["rich_text"]
+        else None
+    )
+
+    coordinates_property = properties["geometry.coordinates"]
+    coordinates = (
+        coordinates_property["title"][0]["text"]["content"]
+        if "title" in coordinates_property and coordinates_property["title"]
+        else None
+    )
+
+    image_property = properties["properties.image"]
+    image = (
+        image_property["files"][0]["name"]
+        if "files" in image_property and image_property["files"]
+        else None
+    )
+
+    text_property = properties["properties.text"]
+    text = (
+        text_property["rich_text"][0]["plain_text"]
+        if "rich_text" in text_property and text_property["rich_text"]
+        else ""
+    )
+    longitude, latitude = map(float, coordinates.strip("[]").split(","))
+
+    return {
+        "id": item_id,
+        "name": name,
+        "layer": layer,
+        "text": text,
+        "location": {"type": "Point", "coordinates": [longitude, latitude]},
+        "image": image,
+        "link": link,
+    }
+
+
+async def get_buildings_from_notion(notion, progress, since=None):
+    """
+    Streams building data from a Notion database.
+
+    Retrieves building data from the Notion database specified by the NOTION_DB constant
+    with the async Notion client, so the event loop keeps serving users meanwhile.
+    The data includes the building's ID, name, layer, text, coordinates, image, and link.
+    The ids of all fetched pages are recorded in progress.seen_ids.
+
+    Args:
+        since (str): ISO timestamp. If given, only pages edited since then are fetched.
+    """
+    query_filter = (
+        {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since}}
+        if since
+        else None
+    )
+
+    async for results in iter_notion_results(notion, query_filter):
+        progress.fetched += len(results)
+
+        for notion_data in results:
+            progress.seen_ids.add(notion_data["id"])
+            building = parse_building(notion_data)
+            if building is not None:
+                yield building
+
+
+async def remove_buildings(collection, item_ids):
+    if not item_ids:
+        return 0
+
+    result = await collection.delete_many({"id": {"$in": item_ids}})
+    return result.deleted_count
+
+
+async def sync_buildings(full=False, progress=None):
+    """
+    Synchronizes buildings_collection with Notion.
+
+    Pages flow through parse -> check_for_duplicates -> load_buildings_to_mongo
+    as a chain of async generators, so upserts start with the first Notion response
+    and memory does not grow with the dataset.
+
+    An incremental sync only fetches the pages edited since the watermark of the
+    last successful sync. Notion does not return archived or deleted pages, so
+    only a full sync, which fetches everything, can find the buildings to remove.
+    It runs when asked, when there is no watermark yet, and when the last full
+    sync is older than FULL_SYNC_INTERVAL. The watermark is kept when some
+    buildings failed to write, so the next sync fetches them again.
+
+    Returns:
+        SyncProgress: The final counters, or None on failure.
+    """
+    progress = progress or SyncProgress()
+    started_at = (datetime.now(timezone.utc) - SYNC_WATERMARK_OVERLAP).isoformat()
 
     try:
         collection = await MongoDB().get_collection("buildings_collection")
+        since = None if full else await get_sync_watermark()
+        progress.full = since is None
     except Exception as e:
         logging.error(f"Failed to connect to MongoDB: {str(e)}")
-        return
+        return None
 
-    results = []
-    next_cursor = None
     try:
-        while True:
-            response = notion.databases.query(
-                database_id=NOTION_DB, page_size=100, start_cursor=next_cursor
-            )
-            results += response.get("results")
-            next_cursor = response.get("next_cursor")
-
-            if not next_cursor:
-                break
+        notion = AsyncClient(auth=NOTION_API_TOKEN)
     except Exception as e:
-        logging.error(f"Failed to gather data: {str(e)}")
-        return
+        logging.error(f"Failed to connect to Notion: {str(e)}")
+        return None
 
-    buildings_list = []
+    try:
+        buildings = get_buildings_from_notion(notion, progress, since)
+        known_buildings = BuildingsIndex().buildings if since else ()
+        stored_links = {
+            document["link"]: document["id"]
+            async for document in collection.find({}, {"_id": 0, "id": 1, "link": 1})
+        }
+        if not await load_buildings_to_mongo(
+            check_for_duplicates(buildings, progress, known_buildings, stored_links),
+            progress,
+        ):
+            return None
+    finally:
+        await notion.aclose()
 
-    for notion_data in results:
-        properties = notion_data["properties"]
-        item_id = notion_data["id"]
+    try:
+        removed_ids = []
+        if since is None:
+            stored_ids = await collection.distinct("id")
+            removed_ids = [
+                item_id for item_id in stored_ids if item_id not in progress.seen_ids
+            ]
+        progress.removed = await remove_buildings(collection, removed_ids)
+        if not progress.failed_ids:
+            await save_sync_watermark(started_at, full=since is None)
+    except Exception as e:
+        logging.error(f"Failed to finish Notion sync: {str(e)}")
+        return None
 
-        if properties["properties.layer"]["select"] is not None:
-            layer = properties["properties.layer"]["select"]["name"]
-        else:
-            continue
+    return progress
 
-        topos_id = properties["properties.topos_id"]["number"]
-        taxonomy_id = properties["properties.taxonomy_id"]["number"]
-        link = f"https://topos.memo.ru/article/{topos_id}+{taxonomy_id}"
-
-        current_doc = await collection.find_one({"id": item_id})
-        views_counter = current_doc["views"] if current_doc else 0
-        name_property = properties["properties.name"]
-        name = (
-            name_property["rich_text"][0]["text"]["content"]
-            if "rich_text" in name_property and name_property["rich_text"]
-            else None
-        )
-
-        coordinates_property = properties["geometry.coordinates"]
-        coordinates = (
-            coordinates_property["title"][0]["text"]["content"]
-            if "title" in coordinates_property and coordinates_property["title"]
-            else None
-        )
-
-        image_property = properties["properties.image"]
-        image = (
-            image_property["files"][0]["name"]
-            if "files" in image_property and image_property["files"]
-            else None
-        )
-
-        text_property = properties["properties.text"]
-        text = (
-            text_property["rich_text"][0]["plain_text"]
-            if "rich_text" in text_property and text_property["rich_text"]
-            else ""
-        )
-        longitude, latitude = map(float, coordinates.strip("[]").split(","))
-
-        buildings_list.append(
-            {
-                "id": item_id,
-                "name": name,
-                "layer": layer,
-                "text": text,
-                "location": {"type": "Point", "coordinates": [longitude, latitude]},
-                "image": image,
-                "link": link,
-                "views": views_counter,
-            }
-        )
 
-    return buildings_list
+def duplicate_key(building):
+    topos_id = building["link"].rsplit("/", 1)[-1].split("+")[0]
+    return building["name"], topos_id
 
 
-async def check_for_duplicates(buildings_list):
-    pure_buildings_list = []
+async def check_for_duplicates(buildings, progress, known_buildings=(), stored_links=None):
+    """
+    Drops buildings with the same name and topos article, or the same link,
+    as an already seen one.
+
+    Seen buildings are kept in dicts keyed by (name, topos_id) and by link, so every
+    check is two lookups. The link is unique in buildings_collection, so a second
+    page with it would fail the bulk write. Dropped ids are recorded in
+    progress.collapsed under the id of the building that was kept, for the content
+    editors to fix in Notion.
+
+    Args:
+        known_buildings: Buildings already in the collection that count as seen,
+            used by incremental syncs that only stream the edited pages.
+        stored_links: Link -> id of the buildings in the collection. A page may
+            only take the link of its own stored building, in full syncs too,
+            since the stored one keeps the link until the end of the sync.
+    """
+    kept_ids = {duplicate_key(building): building["id"] for building in known_buildings}
+    kept_links = {building["link"]: building["id"] for building in known_buildings}
+    kept_links.update(stored_links or {})
+
+    async for building in buildings:
+        kept_id = kept_ids.get(duplicate_key(building), building["id"])
+        if kept_id == building["id"]:
+            kept_id = kept_links.get(building["link"], building["id"])
+
+        if kept_id != building["id"]:
+            progress.duplicates += 1
+            progress.collapsed.setdefault(kept_id, []).append(building["id"])
+            continue
 
-    for building in buildings_list:
-        name = building["name"]
-        link = building["link"]
-        stripped_link = link.split("+")[0]
+        kept_ids[duplicate_key(building)] = building["id"]
+        kept_links[building["link"]] = building["id"]
+        yield building
 
-        if any(
-            b["name"] == name and b["link"].split("+")[0] == stripped_link
-            for b in pure_buildings_list
-        ):
-            continue
 
-        pure_buildings_list.append(building)
+async def iter_chunks(items, size):
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
 
-    return pure_buildings_list
+    if chunk:
+        yield chunk
 
 
 # async def make_viewbox():
@@ -147,14 +331,36 @@ async def check_for_duplicates(buildings_list):
 #         return viewbox
 
 
-async def load_buildings_to_mongo(buildings_list):
+def building_content_hash(building):
+    """
+    Hash of the building fields that come from Notion.
     """
-    Loads the list of building data into a MongoDB collection.
+    return hashlib.sha1(
+        json.dumps(building, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+def count_partial_write(details, operations, progress):
+    progress.added += details.get("nUpserted", 0)
+    progress.updated += details.get("nModified", 0)
+
+    for error in details.get("writeErrors", []):
+        item_id = operations[error["index"]]._filter["id"]
+        progress.failed_ids.append(item_id)
+        logging.error(f"Failed to write building {item_id}: {error.get('errmsg')}")
+
 
-    For each building, if a record with the same 'id' exists in the collection,
-    it updates the record with the new data if any parameters have changed.
-    If no such record exists, it inserts the new data.
-    After loading the data, it creates a geospatial index on the 'location' field for efficient querying.
+async def load_buildings_to_mongo(buildings, progress):
+    """
+    Loads a stream of building data into a MongoDB collection.
+
+    Buildings are taken in chunks of BULK_WRITE_CHUNK_SIZE. Buildings whose content
+    hash matches the stored one are skipped, the rest are upserted by 'id' with an
+    unordered bulk_write, and the added/updated counts are taken from the BulkWriteResult.
+    The rest of an unordered write is applied when some of its upserts fail, so
+    the failed ids are recorded in progress.failed_ids and loading goes on.
+    New buildings start with a zero views counter and the counter of an existing
+    building is never written here, so concurrent increments are not overwritten.
     """
     try:
         collection = await MongoDB().get_collection("buildings_collection")
@@ -162,58 +368,61 @@ async def load_buildings_to_mongo(buildings_list):
         logging.error(f"Failed to connect to MongoDB: {str(e)}")
         return False
 
-    added_count = 0
-    updated_count = 0
-
     try:
-        operations = []
-
-        for building in buildings_list:
-            result = await collection.update_one(
-                {"id": building["id"]}, {"$set": building}, upsert=True
-            )
-
-            if result.upserted_id is not None:
-                added_count += 1
-            elif result.modified_count > 0:
-                updated_count += 1
-
-        if operations:
-            await collection.bulk_write(operations)
+        async for chunk in iter_chunks(buildings, BULK_WRITE_CHUNK_SIZE):
+            stored_hashes = {
+                document["id"]: document.get("content_hash")
+                async for document in collection.find(
+                    {"id": {"$in": [building["id"] for building in chunk]}},
+                    {"_id": 0, "id": 1, "content_hash": 1},
+                )
+            }
 
-        if "location_2dsphere" not in await collection.index_information():
-            await collection.create_index([("location", GEOSPHERE)])
+            operations = []
+            for building in chunk:
+                content_hash = building_content_hash(building)
+                if stored_hashes.get(building["id"]) == content_hash:
+                    progress.unchanged += 1
+                    continue
+
+                operations.append(
+                    UpdateOne(
+                        {"id": building["id"]},
+                        {
+                            "$set": {**building, "content_hash": content_hash},
+                            "$setOnInsert": {"views": 0},
+                        },
+                        upsert=True,
+                    )
+                )
+
+            if operations:
+                try:
+                    result = await collection.bulk_write(operations, ordered=False)
+                except BulkWriteError as e:
+                    count_partial_write(e.details, operations, progress)
+                    continue
+                progress.added += result.upserted_count
+                progress.updated += result.modified_count
 
     except Exception as e:
-        logging.error(f"Failed to upsert building: {str(e)}")
+        logging.error(f"Failed to load buildings: {str(e)}")
         return False
 
-    return added_count, updated_count
+    return True
 
 
 async def increment_views_counter(page_id):
     """
-    Increments the view counter for a page in the MongoDB collection.
+    Increments the view counter for a page.
 
-    If the page ID is found in the MongoDB collection, it increments the 'views' field for that page.
+    The increment is accumulated in memory by ViewsCounter and written to the
+    MongoDB collection in batches, and the view is counted in the usage stats.
     If the page ID is not found, it returns None.
     """
+    UsageStats().record("view", building_id=page_id)
     try:
-        collection = await MongoDB().get_collection("buildings_collection")
-    except Exception as e:
-        logging.error(f"Failed to connect to MongoDB: {str(e)}")
-        return None
-
-    try:
-        result = await collection.update_one(
-            {"id": page_id}, {"$inc": {"views": 1}}, upsert=False
-        )
-
-        if result.matched_count > 0:
-            page = await collection.find_one({"id": page_id})
-            new_views_counter = page["views"]
-            return new_views_counter
-
+        return await ViewsCounter().increment(page_id)
     except Exception as e:
         logging.error(f"Failed to increment views counter: {str(e)}")
         return None
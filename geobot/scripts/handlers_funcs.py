@@ -1,5 +1,8 @@
 import asyncio
+import logging
 import random
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 
 from aiogram import types
 from aiogram.dispatcher.storage import FSMContext
@@ -7,19 +10,29 @@ from aiogram.types import (CallbackQuery, InlineKeyboardButton,
                            InlineKeyboardMarkup, InputMediaPhoto,
                            KeyboardButton, Message, ParseMode,
                            ReplyKeyboardMarkup)
+from aiogram.utils.exceptions import MessageNotModified
 from geopy.exc import GeocoderTimedOut, GeocoderUnavailable, GeocoderInsufficientPrivileges
-from geopy.geocoders import Nominatim
-from scripts.building_info_scripts import (create_keyboard,
-                                           create_keyboard_for_saved_message,
-                                           get_building_properties,
-                                           handle_location,
+from scripts.building_info_scripts import (CardRenderCache,
+                                           get_building_from_cursor,
+                                           get_carousel, handle_location,
                                            send_geo_by_coordinates)
-from scripts.from_notion import (check_for_duplicates,
-                                 get_buildings_from_notion,
-                                 increment_views_counter,
-                                 load_buildings_to_mongo)
+from scripts.from_notion import (SyncProgress, increment_views_counter,
+                                 sync_buildings)
+from scripts.live_location import live_scheduler
+from utils.broadcast import Broadcaster
 from utils.db import MongoDB
-from utils.utils import ADMIN_GROUP_ID, UserStates, dp
+from utils.geocoding import Geocoder
+from utils.lease import Lease
+from utils.photo_cache import PhotoCache
+from utils.search_index import BuildingsSearchIndex
+from utils.spatial_index import BuildingsIndex
+from utils.usage_stats import UsageStats, get_day
+from utils.user_registry import UserRegistry
+from utils.utils import (ADMIN_GROUP_ID, EXAMPLE_PLACES, PHOTO_PREWARM,
+                         REFRESH_PROGRESS_INTERVAL, STATS_PERIOD_DAYS,
+                         STATS_TOP_BUILDINGS, UserStates, dp)
+
+refresh_task = None
 
 
 def menu_keyboard():
@@ -47,17 +60,12 @@ async def send_welcome_message(message: types.Message):
 
 
 async def add_new_user_to_mongo(user_id):
-    collection = await MongoDB().get_collection("users")
-    existing_user = await collection.find_one({"id": user_id})
-
-    if existing_user is None:
-        user_data = {"id": user_id}
-        await collection.insert_one(user_data)
-
+    UserRegistry().register(user_id)
     return True
 
 
 async def handle_start(message):
+    UsageStats().record("start", user_id=message.from_user.id)
     await add_new_user_to_mongo(message.from_user.id)
     await send_welcome_message(message)
 
@@ -70,21 +78,8 @@ async def handle_street_search_button(message: Message, state: FSMContext):
         call: An Aiogram CallbackQuery object.
         state: An Aiogram FSMContext object.
     """
-    places = [
-        "Улица Солянка, Москва",
-        "Даниловский монастырь",
-        "Бутырская тюрьма",
-        "Камергерский переулок, 2",
-        "Лубянская площадь",
-        "Таганская улица",
-        "Петровка, 38",
-        "Метро Чистые пруды",
-        "МГУ",
-        "Улица Воздвиженка",
-    ]
-
     await state.set_state(UserStates.street_search)
-    random_places = random.sample(places, 3)
+    random_places = random.sample(EXAMPLE_PLACES, 3)
     await message.answer(
         text=f"Напишите адрес в свободном формате.\n\nНапример\n{random_places[0]}\n{random_places[1]}\n{random_places[2]}"
     )
@@ -106,8 +101,9 @@ async def handle_any_location(message: types.Message, state: FSMContext):
 
 async def search_geo_by_street(message: types.Message, state: FSMContext):
     """
-    Handles the search for a location based on a street name input by the user. Uses the
-    geopy's Nominatim geocoder to convert the street name into geographic coordinates.
+    Handles the search for a location based on a street name input by the user. If the text
+    matches the name of a building, its card is shown right away. Otherwise uses the
+    shared cached Nominatim geocoder to convert the street name into geographic coordinates.
     If a location is found, the bot sends the location's coordinates to the user and invokes the
     handle_location function. If the geocoder encounters a timeout or unavailability error,
     it informs the user to try again.
@@ -124,13 +120,18 @@ async def search_geo_by_street(message: types.Message, state: FSMContext):
     )
     back_from_search_kb.insert(back_button)
 
+    UsageStats().record("search", user_id=message.from_user.id)
+    matched_ids = BuildingsSearchIndex().search(message.text)
+    building = BuildingsIndex().by_id.get(matched_ids[0]) if matched_ids else None
+    if building is not None:
+        longitude, latitude = building["location"]["coordinates"]
+        await state.finish()
+        await handle_location(message, state, lat_user=latitude, lon_user=longitude)
+        return
+
     # viewbox = await make_viewbox()
-    geolocator = Nominatim(user_agent="memo_geobot")
     try:
-        location = geolocator.geocode(
-            f"{message.text}", namedetails=1, country_codes="ru"
-        )
-        await asyncio.sleep(1)
+        location = await Geocoder().geocode(message.text)
 
         if not location:
             await message.reply(
@@ -139,10 +140,11 @@ async def search_geo_by_street(message: types.Message, state: FSMContext):
             )
             return
 
+        latitude, longitude = location
         await dp.bot.send_location(
             chat_id=message.from_user.id,
-            longitude=location.longitude,
-            latitude=location.latitude,
+            longitude=longitude,
+            latitude=latitude,
             reply_to_message_id=message.message_id,
         )
         await dp.bot.send_message(
@@ -161,9 +163,7 @@ async def search_geo_by_street(message: types.Message, state: FSMContext):
         # )
         await state.finish()
 
-        await handle_location(
-            message, state, lat_user=location.latitude, lon_user=location.longitude
-        )
+        await handle_location(message, state, lat_user=latitude, lon_user=longitude)
 
     except (GeocoderTimedOut, GeocoderUnavailable, GeocoderInsufficientPrivileges):
         await message.reply("Что-то пошло не так, попробуйте еще раз")
@@ -172,33 +172,126 @@ async def search_geo_by_street(message: types.Message, state: FSMContext):
 
 async def refresh_buildings_info(message: types.Message):
     """
-    Refresh buildings information.
+    Refresh buildings information. Only the pages edited since the last refresh are
+    fetched, "/refresh_database full" refetches everything and removes deleted pages.
+    The first refresh more than FULL_SYNC_INTERVAL after the last full one is full too.
+    The refresh runs in the background, only one at a time across all workers.
 
     Args:
         message: An Aiogram types.Message object.
     """
+    global refresh_task
 
     if message.chat.id == ADMIN_GROUP_ID:
+        lease = Lease("buildings_refresh")
+        if not await lease.acquire():
+            await message.reply("Обновление уже идет ⏳")
+            return
 
-        status_message = await message.reply(
-            "Обновление займет примерно 1.5 минуты ⏳\n\nПо заверешению придет тэг"
-        )
+        refresh_task = asyncio.create_task(lease.run(run_buildings_refresh(message)))
 
-        buildings_list = await get_buildings_from_notion()
-        pure_buildings_list = await check_for_duplicates(buildings_list)
-        added_count, updated_count = await load_buildings_to_mongo(pure_buildings_list)
 
-        # VIEWBOX = await make_viewbox()
+def format_sync_progress(progress: SyncProgress) -> str:
+    text = (
+        f"Получено из Notion: {progress.fetched}\n"
+        f"Добавлено: {progress.added}\n"
+        f"Обновлено: {progress.updated}\n"
+        f"Без изменений: {progress.unchanged}\n"
+        f"Дубликатов: {progress.duplicates}"
+    )
+    if progress.failed_ids:
+        text += f"\nНе записано (подробности в логах): {len(progress.failed_ids)}"
+    return text
+
+
+def format_removal_note(progress: SyncProgress) -> str:
+    if progress.full:
+        return f"Удалено: {progress.removed}"
+    return (
+        "Удаленные в Notion страницы убираются только при полном обновлении: "
+        "/refresh_database full. Первое обновление спустя сутки после "
+        "последнего полного тоже будет полным"
+    )
+
+
+async def run_buildings_refresh(message: types.Message):
+    status_message = await message.reply(
+        "Обновление запущено ⏳\n\nПо заверешению придет тэг"
+    )
 
-        if added_count or updated_count:
-            await status_message.edit_text(
-                text=f"✅\n\nДобавлено: {added_count}\nОбновлено: {updated_count}"
+    progress = SyncProgress()
+    sync_task = asyncio.create_task(
+        sync_buildings(full=message.get_args() == "full", progress=progress)
+    )
+
+    try:
+        while not sync_task.done():
+            await asyncio.wait({sync_task}, timeout=REFRESH_PROGRESS_INTERVAL)
+            if not sync_task.done():
+                try:
+                    await status_message.edit_text(
+                        text=f"⏳\n\n{format_sync_progress(progress)}"
+                    )
+                except MessageNotModified:
+                    pass
+                except Exception as e:
+                    logging.warning(f"Failed to report refresh progress: {str(e)}")
+    finally:
+        if not sync_task.done():
+            sync_task.cancel()
+            await asyncio.wait({sync_task})
+
+    try:
+        sync_result = sync_task.result()
+    except Exception as e:
+        logging.error(f"Failed to refresh buildings: {str(e)}")
+        sync_result = None
+
+    if sync_result is not None and (
+        sync_result.added or sync_result.updated or sync_result.removed
+    ):
+        await BuildingsIndex().publish()
+        if PHOTO_PREWARM:
+            asyncio.create_task(
+                PhotoCache().prewarm(dp.bot, ADMIN_GROUP_ID, BuildingsIndex().buildings)
             )
-        else:
-            await status_message.edit_text(text=f"Обновлений нет 🤷‍♂️")
 
-        await dp.bot.send_message(
-            text=f"@{message.from_user.username}", chat_id=ADMIN_GROUP_ID, reply_to_message_id=status_message.message_id)
+    # VIEWBOX = await make_viewbox()
+
+    if sync_result is None:
+        await status_message.edit_text(text="❌ Не удалось обновить базу, подробности в логах")
+    elif sync_result.added or sync_result.updated or sync_result.removed:
+        await status_message.edit_text(
+            text=f"✅\n\n{format_sync_progress(sync_result)}\n{format_removal_note(sync_result)}"
+        )
+    else:
+        await status_message.edit_text(
+            text=f"Обновлений нет 🤷‍♂️\n\n{format_removal_note(sync_result)}"
+        )
+
+    if sync_result is not None and sync_result.collapsed:
+        await status_message.reply(
+            text=format_duplicates_report(sync_result.collapsed),
+            disable_web_page_preview=True,
+        )
+
+    await dp.bot.send_message(
+        text=f"@{message.from_user.username}", chat_id=ADMIN_GROUP_ID, reply_to_message_id=status_message.message_id)
+
+
+def format_duplicates_report(collapsed: dict) -> str:
+    lines = ["Дубликаты в Notion (оставлена первая страница):"]
+    for kept_id, dropped_ids in collapsed.items():
+        pages = ", ".join(
+            f"https://www.notion.so/{item_id.replace('-', '')}"
+            for item_id in [kept_id, *dropped_ids]
+        )
+        lines.append(f"• {pages}")
+
+    report = "\n".join(lines)
+    if len(report) > 4000:
+        report = report[:4000].rsplit("\n", 1)[0] + "\n…"
+    return report
 
 
 async def show_stats(message: types.Message):
@@ -211,12 +304,56 @@ async def show_stats(message: types.Message):
     """
     if message.chat.id == ADMIN_GROUP_ID:
         collection = await MongoDB().get_collection("users")
-        total_users = await collection.count_documents({})
-        stats_message = f"Пользуются ботом: {total_users}"
+        total_users = await collection.estimated_document_count()
+
+        usage_stats = UsageStats()
+        await usage_stats.flush()
+        now = datetime.now(timezone.utc)
+        dau_today = await usage_stats.get_daily_active_users(get_day(now))
+        dau_yesterday = await usage_stats.get_daily_active_users(
+            get_day(now - timedelta(days=1))
+        )
+        days = await usage_stats.get_days(STATS_PERIOD_DAYS)
+
+        stats_message = (
+            f"Пользуются ботом: {total_users}\n"
+            f"Активных сегодня: {dau_today}, вчера: {dau_yesterday}\n\n"
+            f"{format_usage_stats(days)}"
+        )
 
         await dp.bot.send_message(text=stats_message, chat_id=ADMIN_GROUP_ID)
 
 
+def format_usage_stats(days: list) -> str:
+    events, buildings, layers = Counter(), Counter(), Counter()
+    for day in days:
+        events.update(day.get("events", {}))
+        for building_id, counters in day.get("buildings", {}).items():
+            buildings[building_id] += counters.get("view", 0)
+        for layer, counters in day.get("layers", {}).items():
+            layers[layer] += counters.get("view", 0)
+
+    lines = [
+        f"За {STATS_PERIOD_DAYS} дней:",
+        f"Геопозиций: {events['location']}",
+        f"Поисков: {events['search']}",
+        f"Просмотров карточек: {events['view']}",
+        f"Сохранений: {events['save']}",
+        "",
+        "Топ зданий:",
+    ]
+    for position, (building_id, views) in enumerate(
+        buildings.most_common(STATS_TOP_BUILDINGS), start=1
+    ):
+        building = BuildingsIndex().by_id.get(building_id)
+        name = building["name"] if building else building_id
+        lines.append(f"{position}. {name}: {views}")
+
+    lines += ["", "Просмотры по слоям:"]
+    lines += [f"• {layer}: {views}" for layer, views in layers.most_common()]
+    return "\n".join(lines)
+
+
 async def get_location(message: types.Message, state: FSMContext):
     """
     Get location.
@@ -225,6 +362,7 @@ async def get_location(message: types.Message, state: FSMContext):
         message: An Aiogram types.Message object.
         state: An Aiogram FSMContext object.
     """
+    UsageStats().record("location", user_id=message.from_user.id)
     if not message.location.live_period:
         await handle_location(
             message,
@@ -233,6 +371,7 @@ async def get_location(message: types.Message, state: FSMContext):
             lon_user=message.location.longitude,
         )
     else:
+        live_scheduler.reset(message.from_user.id)
         await state.update_data(
             {
                 "user_start_point": [
@@ -246,19 +385,13 @@ async def get_location(message: types.Message, state: FSMContext):
 
 async def get_live_geo(message: types.Message, state: FSMContext):
     """
-    Get live location updates.
+    Get live location updates. Edits are coalesced per user by the live location scheduler.
 
     Args:
         message: An Aiogram types.Message object.
         state: An Aiogram FSMContext object.
     """
-    await handle_location(
-        message,
-        state,
-        live=True,
-        lat_user=message.location.latitude,
-        lon_user=message.location.longitude,
-    )
+    await live_scheduler.submit(message, state)
 
 
 async def send_geo(call: CallbackQuery, state: FSMContext):
@@ -280,113 +413,107 @@ async def send_geo(call: CallbackQuery, state: FSMContext):
     await call.answer(cache_time=1)
 
 
-async def get_user_and_building_data_from_cache(call: CallbackQuery, state: FSMContext):
-    user_id = call.from_user.id
-
-    user_data = await state.get_data(user_id)
-    closest_buildings = user_data.get(user_id, None)
+async def get_building_from_callback(call: CallbackQuery, state: FSMContext, callback_data: dict):
+    cursor = await get_carousel(state, callback_data["session"])
+    index = int(callback_data["index"])
 
-    if not closest_buildings:
+    if not cursor or not 0 <= index < len(cursor["buildings"]):
         await call.answer(text="❌ Попробуйте заново отправить геопозицию", cache_time=5)
         return
 
-    link = call.message.reply_markup.inline_keyboard[0][0].url
+    building = await get_building_from_cursor(cursor, index)
+    if building is None:
+        await call.answer(text="❌ Попробуйте заново отправить геопозицию", cache_time=5)
+        return
 
-    return closest_buildings, link
+    return cursor, index, building
 
 
 async def find_building_and_execute(
-    call: CallbackQuery, state: FSMContext, operation: str, offset=0
+    call: CallbackQuery, state: FSMContext, operation: str, callback_data: dict
 ):
-    closest_buildings, link = await get_user_and_building_data_from_cache(call, state)
-
-    for index, building in enumerate(closest_buildings, start=1):
-        if link == building["building_data"]["link"]:
-
-            if operation == "show":
-                (
-                    name,
-                    distance,
-                    photo,
-                    link,
-                    text,
-                    building_id,
-                ) = get_building_properties(closest_buildings, index + offset)
-                choice_menu = create_keyboard(closest_buildings, index + offset, link)
-                views = await increment_views_counter(building_id)
-                await dp.bot.edit_message_media(
-                    media=InputMediaPhoto(
-                        photo,
-                        caption=f"<b>{name}</b>\n\n{text}\n\n{int(round(distance, 2) * 1000)} метров\n{views} 👀",
-                        parse_mode=ParseMode.HTML,
-                    ),
-                    chat_id=call.from_user.id,
-                    message_id=call.message.message_id,
-                    reply_markup=choice_menu,
-                )
-
-            elif operation == "save":
-
-                (
-                    name,
-                    distance,
-                    photo,
-                    link,
-                    text,
-                    building_id,
-                ) = get_building_properties(closest_buildings, index + offset)
-
-                saved_message_menu = create_keyboard_for_saved_message(
-                    closest_buildings, index, link
-                )
-
-                saved_message = await dp.bot.send_photo(
-                    caption=f"<b>{name}</b>\n\n{text}",
-                    chat_id=call.from_user.id,
-                    photo=photo,
-                    reply_markup=saved_message_menu,
-                    reply_to_message_id=building["message_to_reply"],
-                    parse_mode=ParseMode.HTML,
-                )
-                await dp.bot.pin_chat_message(
-                    call.from_user.id,
-                    saved_message.message_id,
-                    disable_notification=True,
-                )
+    found = await get_building_from_callback(call, state, callback_data)
+    if found is None:
+        return
 
-            break
+    cursor, index, building = found
+    render_cache = CardRenderCache()
 
+    if operation == "show":
+        choice_menu = await render_cache.keyboard(
+            building, index, len(cursor["buildings"]), callback_data["session"]
+        )
+        views = await increment_views_counter(building["id"])
+        caption = await render_cache.caption(building, views)
+        await PhotoCache().send(
+            building["id"],
+            building["image"],
+            lambda photo: dp.bot.edit_message_media(
+                media=InputMediaPhoto(photo, caption=caption, parse_mode=ParseMode.HTML),
+                chat_id=call.from_user.id,
+                message_id=call.message.message_id,
+                reply_markup=choice_menu,
+            ),
+        )
 
-async def show_building(call: CallbackQuery, state: FSMContext, direction: str):
-    offset = -2 if direction == "previous" else 0
-    await find_building_and_execute(call, state, "show", offset)
+    elif operation == "save":
+        UsageStats().record("save", user_id=call.from_user.id, building_id=building["id"])
+        saved_message_menu = await render_cache.saved_keyboard(building)
+        caption = await render_cache.saved_caption(building)
+
+        saved_message = await PhotoCache().send(
+            building["id"],
+            building["image"],
+            lambda photo: dp.bot.send_photo(
+                caption=caption,
+                chat_id=call.from_user.id,
+                photo=photo,
+                reply_markup=saved_message_menu,
+                reply_to_message_id=cursor["message_to_reply"],
+                parse_mode=ParseMode.HTML,
+            ),
+        )
+        await dp.bot.pin_chat_message(
+            call.from_user.id,
+            saved_message.message_id,
+            disable_notification=True,
+        )
 
 
-async def show_next_building(call: CallbackQuery, state: FSMContext):
-    await show_building(call, state, direction="next")
+async def show_building(call: CallbackQuery, state: FSMContext, callback_data: dict):
+    await find_building_and_execute(call, state, "show", callback_data)
 
 
-async def show_previous_building(call: CallbackQuery, state: FSMContext):
-    await show_building(call, state, direction="previous")
+async def save_builing_message(call: CallbackQuery, state: FSMContext, callback_data: dict):
+    await find_building_and_execute(call, state, "save", callback_data)
 
 
-async def save_builing_message(call: CallbackQuery, state: FSMContext):
-    offset = -1
-    await find_building_and_execute(call, state, "save", offset)
+async def handle_outdated_carousel(call: CallbackQuery):
+    await call.answer(text="❌ Попробуйте заново отправить геопозицию", cache_time=5)
 
 
 async def mailing(message: types.Message):
     """
-    Handles a mailing task. When a message is received from the admin group, it prepares the text
-    with correct HTML formatting and sends it to all the users. The user list is fetched from a
-    JSON file. It then logs any exceptions and sends a message back to the admin about the
-    number of users that received the message.
+    Handles a mailing task. When a message is received from the admin group, it starts
+    a background broadcast to all the users. If the command is a reply, the replied
+    message is copied to the users, media included. Otherwise the text after the first
+    line is sent with correct HTML formatting. The broadcaster sends one report to the
+    admin group when the mailing is done.
 
     Args:
         message: An Aiogram types.Message object.
-        dp: Dispatcher object.
     """
     if message.chat.id == ADMIN_GROUP_ID:
+        broadcaster = Broadcaster(dp.bot, ADMIN_GROUP_ID)
+
+        if message.reply_to_message:
+            await broadcaster.start(
+                from_chat_id=message.chat.id,
+                message_id=message.reply_to_message.message_id,
+            )
+            await message.answer(text="Рассылка запущена ⏳")
+            return
+
         mailing_text = "\n".join(message.text.split("\n")[1:])
 
         entities = message.entities
@@ -397,24 +524,10 @@ async def mailing(message: types.Message):
                     link_text, f'<a href="{entity.url}">{link_text}</a>'
                 )
 
-        collection = await MongoDB().get_collection("users")
-        total_users = await collection.count_documents({})
-
-        cursor = collection.find({}, {"_id": 0, "id": 1})
-
-        for user in await cursor.to_list(length=None):
-            chat_id = user["id"]
-            try:
-                await dp.bot.send_message(
-                    text=mailing_text, chat_id=chat_id, parse_mode="HTML"
-                )
-            except Exception as e:
-                await message.answer(
-                    text=f'Failed to send message to user" {user}. Error: {e}"\n\n@sapalexdr'
-                )
+        await broadcaster.start(text=mailing_text)
         await message.answer(
             parse_mode="HTML",
-            text=f"Юзеров получили сообщение: {(total_users)}\n{mailing_text}",
+            text=f"Рассылка запущена ⏳\n{mailing_text}",
         )
 
 
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+
+import aiogram
+from scripts.building_info_scripts import create_building_dict, handle_location
+from utils.spatial_index import BuildingsIndex, haversine, safe_margin
+from utils.utils import (CLOSEST_BUILDINGS_LIMIT, DYNAMIC_RADIUS,
+                         LIVE_MIN_DISPLACEMENT, LIVE_TICK_INTERVAL)
+
+
+class LiveLocationScheduler:
+    """
+    Batched scheduler for live location edits.
+
+    Edits are collected for tick_interval seconds, replacing each other per user,
+    so a user is served from the latest position only. On every tick the users
+    that moved far enough are evaluated together with one batch query against
+    the buildings index, then every user's answer is sent separately. Only one
+    answer per user is sent at a time; a user still being answered waits for
+    the next tick. A new position is skipped when the user moved less than
+    min_displacement or less than the margin in which the nearest-building
+    answer cannot change.
+    """
+
+    def __init__(
+        self,
+        radius: float = DYNAMIC_RADIUS,
+        min_displacement: float = LIVE_MIN_DISPLACEMENT,
+        tick_interval: float = LIVE_TICK_INTERVAL,
+    ):
+        self.radius = radius
+        self.min_displacement = min_displacement
+        self.tick_interval = tick_interval
+        self.pending = {}
+        self.active = set()
+        self.anchors = {}
+        self.last_edit = {}
+        self.task = None
+
+    def reset(self, user_id: int):
+        self.anchors.pop(user_id, None)
+        self.last_edit.pop(user_id, None)
+
+    async def submit(
+        self, message: aiogram.types.Message, state: aiogram.dispatcher.storage.FSMContext
+    ):
+        user_id = message.from_user.id
+        edit_date = message.edit_date or message.date
+
+        if edit_date and self.last_edit.get(user_id) and edit_date < self.last_edit[user_id]:
+            return
+
+        self.last_edit[user_id] = edit_date
+        self.pending[user_id] = (message, state)
+        self._schedule()
+
+    def _schedule(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._tick())
+
+    async def _tick(self):
+        await asyncio.sleep(self.tick_interval)
+        self.task = None
+
+        batch = []
+        for user_id in list(self.pending):
+            if user_id in self.active:
+                continue
+            message, state = self.pending.pop(user_id)
+            if self._moved(user_id, message.location):
+                batch.append((user_id, message, state))
+
+        if not batch:
+            return
+
+        points = [
+            (message.location.latitude, message.location.longitude)
+            for _, message, _ in batch
+        ]
+        for (user_id, message, state), (closest, margin) in zip(batch, self.evaluate(points)):
+            self.active.add(user_id)
+            asyncio.create_task(self._process(user_id, message, state, closest, margin))
+
+    def _moved(self, user_id: int, location: aiogram.types.Location) -> bool:
+        anchor = self.anchors.get(user_id)
+        if not anchor:
+            return True
+
+        lat_anchor, lon_anchor, margin = anchor
+        moved = haversine(lat_anchor, lon_anchor, location.latitude, location.longitude)
+        return moved >= self.min_displacement and moved >= margin
+
+    def evaluate(self, points: list) -> list:
+        """
+        Closest buildings and safe margin for each of the points.
+
+        Returns:
+            list: (closest buildings, margin) tuples. The closest buildings are
+            None when the index is not loaded, so handle_location queries MongoDB.
+        """
+        index = BuildingsIndex()
+        if not index.loaded or not index.buildings:
+            return [(None, 0) for _ in points]
+
+        inside_many = index.query_radius_many(points, self.radius)
+        limit = max(len(inside) for inside in inside_many) + 1
+        nearest_many = index.query_nearest_many(points, limit)
+
+        return [
+            (
+                [
+                    create_building_dict(building, distance)
+                    for distance, building in inside[:CLOSEST_BUILDINGS_LIMIT]
+                ],
+                safe_margin(inside, nearest, self.radius),
+            )
+            for inside, nearest in zip(inside_many, nearest_many)
+        ]
+
+    async def _process(
+        self,
+        user_id: int,
+        message: aiogram.types.Message,
+        state: aiogram.dispatcher.storage.FSMContext,
+        closest_buildings: list,
+        margin: float,
+    ):
+        lat_user = message.location.latitude
+        lon_user = message.location.longitude
+        try:
+            await handle_location(
+                message,
+                state,
+                live=True,
+                lat_user=lat_user,
+                lon_user=lon_user,
+                closest_buildings=closest_buildings,
+            )
+            self.anchors[user_id] = (lat_user, lon_user, margin)
+        except Exception as e:
+            logging.error(f"Failed to handle live location of {user_id}: {str(e)}")
+        finally:
+            self.active.discard(user_id)
+            if user_id in self.pending:
+                self._schedule()
+
+
+live_scheduler = LiveLocationScheduler()
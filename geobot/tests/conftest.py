@@ -0,0 +1,59 @@
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+from utils.db import MongoDB, SingletonMeta
+
+
+class FakeCollection:
+    """
+    Records the bulk writes made to it, and fails them while fail is set.
+    find ignores the query and yields all of documents.
+    """
+
+    def __init__(self):
+        self.documents = []
+        self.writes = []
+        self.fail = False
+
+    async def _iter_documents(self):
+        for document in self.documents:
+            yield dict(document)
+
+    def find(self, query=None, projection=None):
+        return self._iter_documents()
+
+    async def find_one(self, query, projection=None):
+        return None
+
+    async def bulk_write(self, operations, ordered=True):
+        if self.fail:
+            raise RuntimeError("MongoDB is unavailable")
+        self.writes.append(operations)
+        return SimpleNamespace(upserted_count=0, modified_count=len(operations))
+
+
+@pytest.fixture
+def collections(monkeypatch):
+    """
+    Fake collections by name, served by MongoDB().get_collection.
+    """
+    collections = defaultdict(FakeCollection)
+
+    async def get_collection(name):
+        return collections[name]
+
+    monkeypatch.setattr(MongoDB(), "get_collection", get_collection)
+    return collections
+
+
+@pytest.fixture(autouse=True)
+def fresh_singletons():
+    """
+    Every test gets new instances of the singletons it uses.
+    """
+    instances = dict(SingletonMeta._instances)
+    SingletonMeta._instances.clear()
+    yield
+    SingletonMeta._instances.clear()
+    SingletonMeta._instances.update(instances)
@@ -0,0 +1,68 @@
+import pytest
+from utils.gazetteer import (Gazetteer, build_gazetteer, normalize_house_number,
+                             normalize_query, street_keys)
+
+
+def address(street, house_number, lon, lat):
+    return {
+        "properties": {"addr:street": street, "addr:housenumber": house_number},
+        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+    }
+
+
+@pytest.fixture
+def gazetteer():
+    index = build_gazetteer(
+        [
+            address("улица 1905 года", "3", 37.58, 55.77),
+            address("улица 1905 года", "7", 37.56, 55.76),
+            address("Тверская улица", "7", 37.61, 55.76),
+            address("улица Солянка", "1/2с1", 37.64, 55.75),
+            {
+                "properties": {"name": "Даниловский монастырь"},
+                "geometry": {"type": "Point", "coordinates": [37.63, 55.71]},
+            },
+        ]
+    )
+    gazetteer = Gazetteer()
+    gazetteer.streets = index["streets"]
+    gazetteer.aliases = index["aliases"]
+    gazetteer.places = index["places"]
+    return gazetteer
+
+
+def test_normalize_query():
+    assert normalize_query("  Улица  Солянка, Москва!  ") == "улица солянка, москва"
+    assert normalize_query("Ёлочная") == "елочная"
+
+
+def test_street_keys_ignore_type_order_and_noise():
+    assert street_keys("ул. Солянка, Москва") == ("солянка улица", "солянка")
+    assert street_keys("Солянка улица") == street_keys("улица Солянка")
+
+
+def test_normalize_house_number():
+    assert normalize_house_number("7 корпус 2") == "7к2"
+    assert normalize_house_number("7 корп. 2") == "7к2"
+
+
+def test_resolve_street_with_number_in_name(gazetteer):
+    assert gazetteer.resolve("улица 1905 года") == (55.765, 37.57)
+    assert gazetteer.resolve("улица 1905 года, 7") == (55.76, 37.56)
+
+
+def test_resolve_house_number(gazetteer):
+    assert gazetteer.resolve("Тверская 7") == (55.76, 37.61)
+    assert gazetteer.resolve("ул. Тверская, д. 7") == (55.76, 37.61)
+
+
+def test_resolve_unknown_house_falls_back_to_street(gazetteer):
+    assert gazetteer.resolve("Тверская 99") == (55.76, 37.61)
+
+
+def test_resolve_place(gazetteer):
+    assert gazetteer.resolve("Даниловский монастырь, Москва") == (55.71, 37.63)
+
+
+def test_resolve_unknown(gazetteer):
+    assert gazetteer.resolve("Неизвестная улица 5") is None
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from utils.outbound import OutboundScheduler, Priority, TokenBucket
+
+
+def test_bucket_starts_full():
+    bucket = TokenBucket(rate=1, capacity=3)
+    for _ in range(3):
+        assert bucket.delay(0) == 0
+        bucket.consume(0)
+    assert bucket.delay(0) == pytest.approx(1)
+
+
+def test_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=2, capacity=2)
+    bucket.consume(0)
+    bucket.consume(0)
+    assert bucket.delay(0.25) == pytest.approx(0.25)
+    assert bucket.delay(0.5) == 0
+
+
+def test_bucket_never_exceeds_capacity():
+    bucket = TokenBucket(rate=10, capacity=2)
+    bucket.delay(100)
+    assert bucket.tokens == 2
+
+
+def test_bucket_pause():
+    bucket = TokenBucket(rate=1, capacity=1)
+    bucket.paused_until = 5
+    assert bucket.delay(2) == pytest.approx(3)
+    assert not bucket.is_idle(2)
+    assert bucket.is_idle(5)
+
+
+def test_pause_everyone_holds_back_other_chats():
+    async def run():
+        scheduler = OutboundScheduler(global_rate=100)
+        await scheduler.acquire(Priority.MAILING, 1)
+
+        scheduler.pause(1, 0.2)
+        await asyncio.wait_for(scheduler.acquire(Priority.MAILING, 2), 0.1)
+
+        scheduler.pause(1, 0.2, everyone=True)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.acquire(Priority.MAILING, 3), 0.1)
+        scheduler.task.cancel()
+
+    asyncio.run(run())
+
+
+def test_higher_priority_goes_first():
+    async def run():
+        scheduler = OutboundScheduler()
+        scheduler.global_bucket = TokenBucket(rate=10, capacity=1)
+        await scheduler.acquire(Priority.REPLY, 0)
+
+        order = []
+
+        async def send(priority, chat_id):
+            await scheduler.acquire(priority, chat_id)
+            order.append(priority)
+
+        mailing = asyncio.create_task(send(Priority.MAILING, 1))
+        await asyncio.sleep(0)
+        reply = asyncio.create_task(send(Priority.INTERACTIVE, 2))
+        await asyncio.wait_for(asyncio.gather(mailing, reply), 3)
+        scheduler.task.cancel()
+        return order
+
+    assert asyncio.run(run()) == [Priority.INTERACTIVE, Priority.MAILING]
@@ -0,0 +1,50 @@
+from utils.search_index import NAME_MATCH_THRESHOLD, BuildingsSearchIndex, trigrams
+
+
+def building(building_id, name, text=""):
+    return {"id": building_id, "name": name, "text": text}
+
+
+def search_index():
+    index = BuildingsSearchIndex()
+    index.build(
+        [
+            building("narkomfin", "Дом Наркомфина", "Стоит у метро Чистые пруды"),
+            building("embankment", "Дом на набережной"),
+            building("nameless", None),
+        ]
+    )
+    return index
+
+
+def test_trigrams_are_padded():
+    assert trigrams("дом") == {"  д", " до", "дом", "ом "}
+
+
+def test_exact_name_matches():
+    assert search_index().search("Дом Наркомфина") == ["narkomfin"]
+
+
+def test_misspelled_name_matches():
+    assert search_index().search("дом наркомфин") == ["narkomfin"]
+
+
+def test_best_match_first():
+    assert search_index().search("Дом на набережной")[0] == "embankment"
+
+
+def test_similarity_below_threshold_does_not_match():
+    query, name = "дом", "дом наркомфина"
+    similarity = len(trigrams(query) & trigrams(name)) / len(trigrams(query) | trigrams(name))
+    assert similarity < NAME_MATCH_THRESHOLD
+    assert search_index().search(query) == []
+
+
+def test_description_text_does_not_match():
+    index = search_index()
+    assert index.search("Метро Чистые пруды") == []
+    assert index.search("Чистые пруды") == []
+
+
+def test_street_address_does_not_match():
+    assert search_index().search("Новинский бульвар, 25") == []
@@ -0,0 +1,164 @@
+import random
+
+import numpy as np
+import pytest
+from utils.spatial_index import (EARTH_RADIUS_KM, BuildingsIndex, haversine,
+                                 haversine_matrix, safe_margin)
+
+
+def building(building_id, lat, lon):
+    return {
+        "id": building_id,
+        "location": {"type": "Point", "coordinates": [lon, lat]},
+    }
+
+
+def brute_force(buildings, lat, lon):
+    distances = [
+        (haversine(lat, lon, *reversed(b["location"]["coordinates"])), b["id"])
+        for b in buildings
+    ]
+    return sorted(distances)
+
+
+@pytest.fixture
+def buildings():
+    generator = random.Random(1)
+    return [
+        building(str(i), 55.75 + generator.uniform(-0.05, 0.05), 37.6 + generator.uniform(-0.05, 0.05))
+        for i in range(1000)
+    ]
+
+
+@pytest.fixture
+def index(buildings):
+    index = BuildingsIndex()
+    index.build(buildings)
+    return index
+
+
+@pytest.fixture
+def points():
+    generator = random.Random(2)
+    return [
+        (55.75 + generator.uniform(-0.07, 0.07), 37.6 + generator.uniform(-0.07, 0.07))
+        for _ in range(100)
+    ]
+
+
+def test_haversine_matrix_matches_haversine():
+    lats, lons = [55.75, 0.0, -33.9], [37.6, 179.9, 18.4]
+    table_lats, table_lons = [55.76, 0.0, 51.5], [37.62, -179.9, -0.1]
+    matrix = haversine_matrix(
+        np.radians(lats), np.radians(lons), np.radians(table_lats), np.radians(table_lons)
+    )
+
+    assert matrix.shape == (3, 3)
+    for row, (lat, lon) in enumerate(zip(lats, lons)):
+        for column, (table_lat, table_lon) in enumerate(zip(table_lats, table_lons)):
+            assert matrix[row, column] == pytest.approx(haversine(lat, lon, table_lat, table_lon))
+
+
+def test_build_sorts_by_latitude(index):
+    assert np.all(np.diff(index.lats) >= 0)
+    assert [b["location"]["coordinates"][1] for b in index.buildings] == pytest.approx(
+        np.degrees(index.lats)
+    )
+
+
+@pytest.mark.parametrize("radius", [0.05, 0.3, 2.0])
+def test_query_radius_many_matches_brute_force(index, buildings, points, radius):
+    for (lat, lon), found in zip(points, index.query_radius_many(points, radius)):
+        expected = [
+            (distance, building_id)
+            for distance, building_id in brute_force(buildings, lat, lon)
+            if distance <= radius
+        ]
+        assert [b["id"] for _, b in found] == [building_id for _, building_id in expected]
+        assert [distance for distance, _ in found] == pytest.approx(
+            [distance for distance, _ in expected]
+        )
+
+
+def test_query_radius_is_one_row_of_the_batch(index, points):
+    batch = index.query_radius_many(points[:5], 0.5, limit=3)
+    for (lat, lon), found in zip(points[:5], batch):
+        assert index.query_radius(lat, lon, 0.5, 3) == found
+        assert len(found) <= 3
+
+
+def test_query_nearest_many_matches_brute_force(index, buildings, points):
+    for (lat, lon), found in zip(points, index.query_nearest_many(points, 4)):
+        expected = brute_force(buildings, lat, lon)[:4]
+        assert [b["id"] for _, b in found] == [building_id for _, building_id in expected]
+
+
+def test_query_nearest_limit_above_table_size():
+    index = BuildingsIndex()
+    index.build([building("a", 55.75, 37.6), building("b", 55.76, 37.6)])
+    assert [b["id"] for _, b in index.query_nearest(55.7, 37.6, limit=5)] == ["a", "b"]
+
+
+def test_empty_table():
+    index = BuildingsIndex()
+    index.build([])
+    assert index.query_radius(55.75, 37.6, 1) == []
+    assert index.query_nearest(55.75, 37.6) == []
+    assert index.query_radius_many([], 1) == []
+
+
+def test_safe_margin_next_building_outside_radius():
+    inside = [(0.03, "a")]
+    nearest = [(0.03, "a"), (0.15, "b")]
+    assert safe_margin(inside, nearest, 0.1) == pytest.approx(0.05)
+
+
+def test_safe_margin_second_building_may_overtake():
+    inside = [(0.02, "a"), (0.06, "b")]
+    nearest = [(0.02, "a"), (0.06, "b"), (0.5, "c")]
+    assert safe_margin(inside, nearest, 0.1) == pytest.approx(0.02)
+
+
+def test_safe_margin_nothing_inside():
+    assert safe_margin([], [(0.4, "a")], 0.1) == pytest.approx(0.3)
+
+
+def test_safe_margin_without_buildings():
+    assert safe_margin([], [], 0.1) == 0
+
+
+def test_safe_margin_is_never_negative():
+    inside = [(0.05, "a"), (0.05, "b")]
+    assert safe_margin(inside, inside, 0.1) == 0
+
+
+def assert_no_other_closest(index, lat, lon, inside, margin, radius):
+    """
+    After moving less than the margin, only a building that was inside the radius
+    may be inside it, and none but the closest one may become the closest.
+    """
+    moved = index.query_radius(lat + np.degrees(margin * 0.99 / EARTH_RADIUS_KM), lon, radius)
+    assert {b["id"] for _, b in moved} <= {b["id"] for _, b in inside}
+    if moved:
+        assert moved[0][1] is inside[0][1]
+
+
+def test_safe_margin_no_other_building_becomes_closest(index, points):
+    radius = 0.3
+    inside_many = index.query_radius_many(points, radius)
+    nearest_many = index.query_nearest_many(points, max(map(len, inside_many)) + 1)
+
+    for (lat, lon), inside, nearest in zip(points, inside_many, nearest_many):
+        margin = safe_margin(inside, nearest, radius)
+        assert_no_other_closest(index, lat, lon, inside, margin, radius)
+
+
+def test_safe_margin_closest_may_leave_radius():
+    index = BuildingsIndex()
+    index.build([building("a", 55.7509, 37.6), building("b", 55.80, 37.6)])
+    inside = index.query_radius(55.75, 37.6, 0.3)
+    nearest = index.query_nearest(55.75, 37.6, len(inside) + 1)
+    margin = safe_margin(inside, nearest, 0.3)
+
+    assert margin > 1
+    assert_no_other_closest(index, 55.75, 37.6, inside, margin, 0.3)
@@ -0,0 +1,89 @@
+import asyncio
+
+from utils.user_registry import UserRegistry
+
+
+def written(collection):
+    return [
+        (operation._filter, operation._doc)
+        for operations in collection.writes
+        for operation in operations
+    ]
+
+
+def test_repeat_start_does_not_write(collections):
+    async def run():
+        collections["users"].documents = [{"id": 1}]
+        registry = UserRegistry()
+        await registry.load()
+        registry.register(1)
+        registry.register(1)
+        await registry.flush()
+
+    asyncio.run(run())
+    assert collections["users"].writes == []
+
+
+def test_new_users_are_upserted_in_one_batch(collections):
+    async def run():
+        registry = UserRegistry()
+        await registry.load()
+        registry.register(1)
+        registry.register(2)
+        registry.register(1)
+        await registry.flush()
+        await registry.flush()
+
+    asyncio.run(run())
+    users = collections["users"]
+    assert len(users.writes) == 1
+    assert [query for query, _ in written(users)] == [{"id": 1}, {"id": 2}]
+    assert all("$setOnInsert" in update for _, update in written(users))
+
+
+def test_start_unblocks_blocked_user_once(collections):
+    async def run():
+        collections["users"].documents = [{"id": 1, "blocked": True}, {"id": 2}]
+        registry = UserRegistry()
+        await registry.load()
+        registry.register(1)
+        registry.register(2)
+        await registry.flush()
+        registry.register(1)
+        await registry.flush()
+
+    asyncio.run(run())
+    assert written(collections["users"]) == [
+        ({"id": 1}, {"$unset": {"blocked": "", "blocked_at": ""}})
+    ]
+
+
+def test_refresh_blocked_picks_up_other_workers_mailings(collections):
+    async def run():
+        collections["users"].documents = [{"id": 1}]
+        registry = UserRegistry()
+        await registry.load()
+
+        collections["users"].documents = [{"id": 1, "blocked": True}]
+        await registry.refresh_blocked()
+        registry.register(1)
+        await registry.flush()
+
+    asyncio.run(run())
+    assert written(collections["users"]) == [
+        ({"id": 1}, {"$unset": {"blocked": "", "blocked_at": ""}})
+    ]
+
+
+def test_failed_flush_is_retried(collections):
+    async def run():
+        registry = UserRegistry()
+        await registry.load()
+        registry.register(1)
+        collections["users"].fail = True
+        await registry.flush()
+        collections["users"].fail = False
+        await registry.flush()
+
+    asyncio.run(run())
+    assert [query for query, _ in written(collections["users"])] == [{"id": 1}]
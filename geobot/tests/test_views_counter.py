@@ -0,0 +1,69 @@
+import asyncio
+
+from utils.spatial_index import BuildingsIndex
+from utils.views_counter import ViewsCounter
+
+
+def building(building_id, views):
+    return {
+        "id": building_id,
+        "views": views,
+        "location": {"type": "Point", "coordinates": [37.6, 55.75]},
+    }
+
+
+def test_increment_adds_pending_views(collections):
+    async def run():
+        BuildingsIndex().build([building("a", 1000)])
+        counter = ViewsCounter()
+        assert await counter.increment("a") == 1001
+        assert await counter.increment("a") == 1002
+        assert await counter.increment("unknown") is None
+
+    asyncio.run(run())
+
+
+def test_flush_writes_deltas(collections):
+    async def run():
+        BuildingsIndex().build([building("a", 1000)])
+        counter = ViewsCounter()
+        await counter.increment("a")
+        await counter.increment("a")
+        await counter.flush()
+        assert await counter.increment("a") == 1003
+
+    asyncio.run(run())
+    (operations,) = collections["buildings_collection"].writes
+    assert [operation._doc for operation in operations] == [{"$inc": {"views": 2}}]
+
+
+def test_reset_between_increment_and_flush(collections):
+    async def run():
+        BuildingsIndex().build([building("a", 1000)])
+        counter = ViewsCounter()
+        assert await counter.increment("a") == 1001
+
+        BuildingsIndex().build([building("a", 1001)])
+        counter.reset_counts(BuildingsIndex().buildings)
+        await counter.flush()
+        return await counter.increment("a")
+
+    assert asyncio.run(run()) == 1002
+
+
+def test_failed_flush_keeps_deltas(collections):
+    async def run():
+        BuildingsIndex().build([building("a", 1000)])
+        counter = ViewsCounter()
+        await counter.increment("a")
+
+        collection = collections["buildings_collection"]
+        collection.fail = True
+        await counter.flush()
+        collection.fail = False
+        await counter.flush()
+        return await counter.increment("a"), collection.writes
+
+    count, writes = asyncio.run(run())
+    assert count == 1002
+    assert [operation._doc for operation in writes[0]] == [{"$inc": {"views": 1}}]
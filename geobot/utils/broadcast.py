@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+
+from aiogram import Bot
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, UserDeactivated
+from utils.db import MongoDB
+from utils.lease import LEASE_TTL, Lease
+from utils.outbound import Priority, current_priority
+
+BROADCAST_BATCH_SIZE = 100
+
+
+class Broadcaster:
+    """
+    Sends a mailing to every user who has not blocked the bot.
+
+    Recipients are streamed from the users collection in _id order and sent
+    concurrently in batches with the lowest outbound priority, so the bot's
+    scheduler keeps rate limits and lets user replies go first. After every
+    batch the last _id and the counters are checkpointed to the mailings collection,
+    so a mailing interrupted by a restart resumes where it stopped.
+    Users who blocked the bot are marked and skipped by later mailings.
+    Every job is guarded by a lease, so with several workers each job is sent
+    by one of them, and a job whose worker died is taken over by another.
+    """
+
+    def __init__(self, bot: Bot, report_chat_id: int):
+        self.bot = bot
+        self.report_chat_id = report_chat_id
+
+    async def start(self, text: str = None, from_chat_id: int = None, message_id: int = None):
+        """
+        Create a mailing job and run it in the background.
+
+        Either text (HTML) or from_chat_id and message_id of a message to copy must be given.
+        """
+        mailings = await MongoDB().get_collection("mailings")
+        job = {
+            "status": "running",
+            "text": text,
+            "from_chat_id": from_chat_id,
+            "message_id": message_id,
+            "last_user_id": None,
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "errors": {},
+            "created_at": datetime.now(timezone.utc),
+        }
+        job["_id"] = (await mailings.insert_one(job)).inserted_id
+        return asyncio.create_task(self.run(job))
+
+    async def resume(self):
+        mailings = await MongoDB().get_collection("mailings")
+        async for job in mailings.find({"status": "running"}):
+            asyncio.create_task(self.run(job))
+
+    async def watch(self, interval: float = LEASE_TTL):
+        """
+        Resume the unfinished mailings now and every interval seconds.
+        """
+        while True:
+            try:
+                await self.resume()
+            except Exception as e:
+                logging.error(f"Failed to resume mailings: {str(e)}")
+            await asyncio.sleep(interval)
+
+    async def run(self, job: dict):
+        lease = Lease(f"mailing:{job['_id']}")
+        if not await lease.acquire():
+            return
+
+        mailings = await MongoDB().get_collection("mailings")
+        job = await mailings.find_one({"_id": job["_id"]})
+        if job is None or job["status"] != "running":
+            await lease.release()
+            return
+
+        logging.info(f"Running mailing {job['_id']}")
+        await lease.run(self._run(job))
+
+    async def _run(self, job: dict):
+        current_priority.set(Priority.MAILING)
+        mailings = await MongoDB().get_collection("mailings")
+        users = await MongoDB().get_collection("users")
+        errors = Counter(job["errors"])
+
+        query = {"blocked": {"$ne": True}}
+        if job["last_user_id"] is not None:
+            query["_id"] = {"$gt": job["last_user_id"]}
+
+        try:
+            cursor = users.find(query, {"_id": 1, "id": 1}).sort("_id", 1)
+            batch = []
+            async for user in cursor:
+                batch.append(user)
+                if len(batch) >= BROADCAST_BATCH_SIZE:
+                    await self._send_batch(job, batch, errors)
+                    await self._checkpoint(mailings, job, errors)
+                    batch = []
+
+            if batch:
+                await self._send_batch(job, batch, errors)
+            job["status"] = "done"
+            await self._checkpoint(mailings, job, errors)
+        except Exception as e:
+            logging.error(f"Mailing {job['_id']} stopped: {str(e)}")
+            await self._checkpoint(mailings, job, errors)
+            return
+
+        await self.bot.send_message(
+            chat_id=self.report_chat_id, text=self.format_report(job, errors)
+        )
+
+    async def _send_batch(self, job: dict, batch: list, errors: Counter):
+        results = await asyncio.gather(*(self._send(job, user["id"]) for user in batch))
+
+        blocked_ids = []
+        for user, result in zip(batch, results):
+            if result == "sent":
+                job["sent"] += 1
+            elif result == "blocked":
+                job["blocked"] += 1
+                blocked_ids.append(user["_id"])
+            else:
+                job["failed"] += 1
+                errors[result] += 1
+
+        if blocked_ids:
+            users = await MongoDB().get_collection("users")
+            await users.update_many(
+                {"_id": {"$in": blocked_ids}},
+                {"$set": {"blocked": True, "blocked_at": datetime.now(timezone.utc)}},
+            )
+
+        job["last_user_id"] = batch[-1]["_id"]
+
+    async def _send(self, job: dict, chat_id: int) -> str:
+        try:
+            if job["message_id"] is not None:
+                await self.bot.copy_message(
+                    chat_id=chat_id,
+                    from_chat_id=job["from_chat_id"],
+                    message_id=job["message_id"],
+                )
+            else:
+                await self.bot.send_message(
+                    chat_id=chat_id, text=job["text"], parse_mode="HTML"
+                )
+            return "sent"
+        except (BotBlocked, UserDeactivated, ChatNotFound):
+            return "blocked"
+        except Exception as e:
+            return type(e).__name__
+
+    async def _checkpoint(self, mailings, job: dict, errors: Counter):
+        job["errors"] = dict(errors)
+        await mailings.update_one(
+            {"_id": job["_id"]},
+            {
+                "$set": {
+                    key: job[key]
+                    for key in ("status", "last_user_id", "sent", "blocked", "failed", "errors")
+                }
+            },
+        )
+
+    @staticmethod
+    def format_report(job: dict, errors: Counter) -> str:
+        report = (
+            f"Рассылка завершена\n\n"
+            f"Доставлено: {job['sent']}\n"
+            f"Заблокировали бота: {job['blocked']}\n"
+            f"Ошибки: {job['failed']}"
+        )
+        for error, count in errors.most_common():
+            report += f"\n• {error}: {count}"
+        return report
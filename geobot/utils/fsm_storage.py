@@ -0,0 +1,192 @@
+import asyncio
+import copy
+import logging
+import typing
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from aiogram.dispatcher.storage import BaseStorage
+from pymongo import DeleteOne, ReplaceOne
+from utils.db import MongoDB
+
+FSM_COLLECTION = "fsm_storage"
+FSM_CACHE_SIZE = 10000
+
+
+class CachedMongoStorage(BaseStorage):
+    """
+    FSM storage persisted to MongoDB behind an in-process write-back cache.
+
+    Every user has one record with the state and the data, which holds the
+    compact carousel cursors (building ids with distances and the start point).
+    Reads are served from the cache and only a miss loads the record from the
+    fsm_storage collection. Writes mark the record dirty and the dirty records
+    are written with one bulk_write every flush interval and on close, so
+    carousels survive a restart. Clean records beyond FSM_CACHE_SIZE are
+    dropped from the cache, least recently used first. Records that are being
+    written stay cached until the write ends, so a failed write is retried
+    with them. Every record carries updated_at, so a TTL index can expire the
+    records of idle users.
+
+    Throttling buckets are kept in memory only. Keys of the data must be strings.
+    """
+
+    def __init__(self, flush_interval: float, cache_size: int = FSM_CACHE_SIZE):
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.records = OrderedDict()
+        self.buckets = {}
+        self.dirty = set()
+        self.in_flight = set()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+
+        dirty, self.dirty = self.dirty, set()
+        self.in_flight |= dirty
+        operations = []
+        for key in dirty:
+            record = self.records.get(key)
+            if record is None or (record["state"] is None and not record["data"]):
+                operations.append(DeleteOne({"_id": key}))
+            else:
+                operations.append(ReplaceOne({"_id": key}, {**record}, upsert=True))
+
+        try:
+            collection = await MongoDB().get_collection(FSM_COLLECTION)
+            await collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logging.error(f"Failed to flush FSM storage: {str(e)}")
+            self.dirty |= dirty
+            return
+        finally:
+            self.in_flight -= dirty
+
+        self._evict()
+
+    def _evict(self, keep: typing.Optional[str] = None):
+        while len(self.records) > self.cache_size:
+            key = next(
+                (
+                    key
+                    for key in self.records
+                    if key not in self.dirty and key not in self.in_flight and key != keep
+                ),
+                None,
+            )
+            if key is None:
+                return
+            del self.records[key]
+
+    def _key(self, chat, user) -> str:
+        chat, user = self.check_address(chat=chat, user=user)
+        return f"{chat}:{user}"
+
+    async def _get_record(self, key: str) -> dict:
+        record = self.records.get(key)
+        if record is not None:
+            self.records.move_to_end(key)
+            return record
+
+        collection = await MongoDB().get_collection(FSM_COLLECTION)
+        loaded = await collection.find_one({"_id": key}, {"_id": 0, "state": 1, "data": 1})
+        record = self.records.setdefault(
+            key, {"state": None, "data": {}, **(loaded or {})}
+        )
+        self.records.move_to_end(key)
+        self._evict(keep=key)
+        return record
+
+    async def _save_record(self, key: str, state, data: dict):
+        record = await self._get_record(key)
+        record["state"] = state
+        record["data"] = data
+        record["updated_at"] = datetime.now(timezone.utc)
+        self.dirty.add(key)
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self._get_record(self._key(chat, user))
+        return record["state"] if record["state"] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._get_record(self._key(chat, user))
+        return copy.deepcopy(record["data"] or default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key = self._key(chat, user)
+        record = await self._get_record(key)
+        await self._save_record(key, self.resolve_state(state), record["data"])
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key = self._key(chat, user)
+        record = await self._get_record(key)
+        await self._save_record(key, record["state"], copy.deepcopy(data or {}))
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        key = self._key(chat, user)
+        record = await self._get_record(key)
+        updated = {**record["data"], **copy.deepcopy(data or {}), **kwargs}
+        await self._save_record(key, record["state"], updated)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        return copy.deepcopy(self.buckets.get(self._key(chat, user), default or {}))
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key = self._key(chat, user)
+        if bucket:
+            self.buckets[key] = copy.deepcopy(bucket)
+        else:
+            self.buckets.pop(key, None)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None,
+                            **kwargs):
+        key = self._key(chat, user)
+        self.buckets.setdefault(key, {}).update(copy.deepcopy(bucket or {}), **kwargs)
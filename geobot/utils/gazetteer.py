@@ -0,0 +1,231 @@
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+from typing import Optional
+
+from utils.db import SingletonMeta
+
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", "gazetteer.json.gz")
+
+STREET_TYPES = {
+    "улица": "улица",
+    "ул": "улица",
+    "переулок": "переулок",
+    "пер": "переулок",
+    "проспект": "проспект",
+    "пр-т": "проспект",
+    "площадь": "площадь",
+    "пл": "площадь",
+    "бульвар": "бульвар",
+    "б-р": "бульвар",
+    "шоссе": "шоссе",
+    "ш": "шоссе",
+    "набережная": "набережная",
+    "наб": "набережная",
+    "проезд": "проезд",
+    "пр-д": "проезд",
+    "тупик": "тупик",
+    "аллея": "аллея",
+    "вал": "вал",
+}
+NOISE_WORDS = {"москва", "г", "город", "россия", "метро", "станция", "м", "дом", "д"}
+HOUSE_NUMBER = re.compile(r"^\d+[а-я]?(?:[/к]\d+[а-я]?)?$")
+
+
+def normalize_query(query: str) -> str:
+    query = query.lower().replace("ё", "е")
+    query = re.sub(r"[^\w\s,./-]", " ", query)
+    return re.sub(r"\s+", " ", query).strip(" ,.")
+
+
+def tokenize(text: str) -> list:
+    return [token for token in re.split(r"[\s,.]+", normalize_query(text)) if token]
+
+
+def street_keys(name: str) -> tuple:
+    """
+    Keys of a street name: with its canonical type ("улица солянка") and without it ("солянка").
+    """
+    words, types = [], []
+    for token in tokenize(name):
+        if token in STREET_TYPES:
+            types.append(STREET_TYPES[token])
+        elif token not in NOISE_WORDS:
+            words.append(token)
+
+    bare_key = " ".join(sorted(words))
+    typed_key = " ".join(sorted(words + types))
+    return typed_key, bare_key
+
+
+def normalize_house_number(house_number: str) -> str:
+    house_number = re.sub(r"корпус|корп\.?", "к", normalize_query(house_number))
+    return re.sub(r"\s+", "", house_number)
+
+
+def feature_point(geometry: dict) -> Optional[list]:
+    """
+    Latitude and longitude of a GeoJSON geometry: the point itself or the mean of its vertices.
+    """
+    if not geometry:
+        return None
+
+    coordinates = geometry.get("coordinates")
+    while coordinates and isinstance(coordinates[0], list) and isinstance(coordinates[0][0], list):
+        coordinates = [point for part in coordinates for point in part]
+
+    if geometry["type"] == "Point":
+        lon, lat = coordinates[:2]
+    elif coordinates:
+        lon = sum(point[0] for point in coordinates) / len(coordinates)
+        lat = sum(point[1] for point in coordinates) / len(coordinates)
+    else:
+        return None
+
+    return [round(lat, 6), round(lon, 6)]
+
+
+def iter_features(path: str):
+    """
+    Reads a GeoJSON FeatureCollection or a GeoJSON sequence (osmium export -f geojsonseq).
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        first_char = file.read(1)
+        file.seek(0)
+
+        if first_char == "{" and '"FeatureCollection"' in file.read(4096):
+            file.seek(0)
+            yield from json.load(file)["features"]
+            return
+
+        file.seek(0)
+        for line in file:
+            line = line.strip().lstrip("\x1e")
+            if line:
+                yield json.loads(line)
+
+
+def build_gazetteer(features) -> dict:
+    """
+    Builds the compact gazetteer index from OSM features.
+
+    Addresses are stored as typed street key -> {house number: [lat, lon]},
+    with the mean of all houses under the "" house number. Bare street keys
+    point to the typed key, and named places map straight to coordinates.
+    """
+    streets, aliases, places = {}, {}, {}
+
+    for feature in features:
+        properties = feature.get("properties") or {}
+        point = feature_point(feature.get("geometry"))
+        if point is None:
+            continue
+
+        street = properties.get("addr:street")
+        house_number = properties.get("addr:housenumber")
+        if street and house_number:
+            typed_key, bare_key = street_keys(street)
+            streets.setdefault(typed_key, {})[normalize_house_number(house_number)] = point
+            aliases.setdefault(bare_key, typed_key)
+        elif properties.get("highway") and properties.get("name"):
+            typed_key, bare_key = street_keys(properties["name"])
+            streets.setdefault(typed_key, {}).setdefault("", point)
+            aliases.setdefault(bare_key, typed_key)
+
+        name = properties.get("name")
+        if name and not properties.get("highway"):
+            places.setdefault(" ".join(token for token in tokenize(name) if token not in NOISE_WORDS), point)
+
+    for houses in streets.values():
+        numbered = [point for number, point in houses.items() if number]
+        if numbered and "" not in houses:
+            houses[""] = [
+                round(sum(point[0] for point in numbered) / len(numbered), 6),
+                round(sum(point[1] for point in numbered) / len(numbered), 6),
+            ]
+
+    return {"streets": streets, "aliases": aliases, "places": places}
+
+
+class Gazetteer(metaclass=SingletonMeta):
+    """
+    Offline Moscow geocoder backed by the index built by build_gazetteer.
+
+    Lookups are plain dictionary reads, so the common street searches are resolved
+    in-process and Nominatim is only asked about what the local index does not know.
+    """
+
+    def __init__(self):
+        self.streets = {}
+        self.aliases = {}
+        self.places = {}
+
+    def load(self, path: str = GAZETTEER_PATH):
+        if not os.path.exists(path):
+            logging.info(f"Gazetteer index {path} not found, street search uses Nominatim only")
+            return False
+
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            index = json.load(file)
+
+        self.streets = index["streets"]
+        self.aliases = index["aliases"]
+        self.places = index["places"]
+        logging.info(f"Gazetteer loaded: {len(self.streets)} streets, {len(self.places)} places")
+        return True
+
+    def resolve(self, query: str) -> Optional[tuple]:
+        """
+        Resolve a street address or a place name.
+
+        The whole query is tried as a place and as a street first, so numbers that
+        are part of a name ("улица 1905 года") are kept. Only then is a trailing
+        number taken as the house number.
+
+        Returns:
+            tuple: Latitude and longitude, or None if the query is not in the index.
+        """
+        tokens = tokenize(query)
+
+        place = self.places.get(
+            " ".join(token for token in tokens if token not in NOISE_WORDS)
+        )
+        if place is not None:
+            return tuple(place)
+
+        houses = self._find_street(tokens)
+        if houses is not None and "" in houses:
+            return tuple(houses[""])
+
+        if len(tokens) < 2 or not HOUSE_NUMBER.match(tokens[-1]):
+            return None
+
+        houses = self._find_street(tokens[:-1])
+        if houses is None:
+            return None
+
+        point = houses.get(tokens[-1], houses.get(""))
+        return tuple(point) if point is not None else None
+
+    def _find_street(self, tokens: list) -> Optional[dict]:
+        typed_key, bare_key = street_keys(" ".join(tokens))
+        houses = self.streets.get(typed_key)
+        if houses is None and typed_key == bare_key:
+            houses = self.streets.get(self.aliases.get(bare_key))
+        return houses
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("Usage: python -m utils.gazetteer <moscow.geojson[seq]> <gazetteer.json.gz>")
+
+    gazetteer = build_gazetteer(iter_features(sys.argv[1]))
+    with gzip.open(sys.argv[2], "wt", encoding="utf-8") as file:
+        json.dump(gazetteer, file, ensure_ascii=False, separators=(",", ":"))
+
+    print(
+        f"{len(gazetteer['streets'])} streets, {len(gazetteer['places'])} places -> {sys.argv[2]}"
+    )
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+
+from geopy.adapters import AioHTTPAdapter
+from geopy.geocoders import Nominatim
+from utils.db import MongoDB, SingletonMeta
+from utils.gazetteer import Gazetteer, normalize_query
+
+NOMINATIM_MIN_DELAY = 1
+GEOCODE_CACHE_SIZE = 1024
+GEOCODE_CACHE_TTL = 30 * 24 * 60 * 60
+
+
+class Geocoder(metaclass=SingletonMeta):
+    """
+    Shared async Nominatim client with caching.
+
+    Queries the offline Gazetteer can resolve never reach the network.
+    Requests to Nominatim are started at most once per NOMINATIM_MIN_DELAY seconds
+    across all users; waiting requests queue on a lock instead of blocking the
+    event loop. With several workers each one waits that many times longer, so
+    together they keep the same rate. Answers are cached by normalized query in an in-process LRU and
+    in the geocode_cache collection, which expires entries after GEOCODE_CACHE_TTL.
+    """
+
+    def __init__(self):
+        self.geolocator = Nominatim(
+            user_agent="memo_geobot", adapter_factory=AioHTTPAdapter
+        )
+        self.lock = asyncio.Lock()
+        self.last_request = 0
+        self.min_delay = NOMINATIM_MIN_DELAY
+        self.cache = OrderedDict()
+
+    def setup(self, workers: int = 1):
+        """
+        Args:
+            workers: Number of worker processes sharing the Nominatim rate limit.
+        """
+        self.min_delay = NOMINATIM_MIN_DELAY * workers
+
+    async def close(self):
+        await self.geolocator.__aexit__(None, None, None)
+
+    def _remember(self, query: str, location: Optional[tuple]):
+        self.cache[query] = location
+        self.cache.move_to_end(query)
+        if len(self.cache) > GEOCODE_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    async def geocode(self, query: str) -> Optional[tuple]:
+        """
+        Geocode a free-form query within Russia.
+
+        Returns:
+            tuple: Latitude and longitude, or None if nothing was found.
+        """
+        query = normalize_query(query)
+        if query in self.cache:
+            self.cache.move_to_end(query)
+            return self.cache[query]
+
+        location = Gazetteer().resolve(query)
+        if location is not None:
+            self._remember(query, location)
+            return location
+
+        collection = await MongoDB().get_collection("geocode_cache")
+        cached = await collection.find_one({"_id": query})
+        if cached is not None:
+            location = tuple(cached["location"]) if cached["location"] else None
+            self._remember(query, location)
+            return location
+
+        await self._wait_for_slot()
+        found = await self.geolocator.geocode(query, namedetails=1, country_codes="ru")
+        location = (found.latitude, found.longitude) if found else None
+
+        self._remember(query, location)
+        await collection.update_one(
+            {"_id": query},
+            {
+                "$set": {
+                    "location": list(location) if location else None,
+                    "created_at": datetime.now(timezone.utc),
+                }
+            },
+            upsert=True,
+        )
+        return location
+
+    async def _wait_for_slot(self):
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            delay = self.last_request + self.min_delay - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.last_request = loop.time()
+
+    async def prewarm(self, queries: list):
+        for query in queries:
+            try:
+                await self.geocode(query)
+            except Exception as e:
+                logging.warning(f"Failed to prewarm geocode cache for {query}: {str(e)}")
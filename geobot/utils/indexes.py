@@ -0,0 +1,119 @@
+import logging
+from datetime import datetime
+from typing import Optional
+
+from pymongo import ASCENDING, GEOSPHERE
+from pymongo.errors import OperationFailure
+from utils.db import MongoDB
+from utils.fsm_storage import FSM_COLLECTION
+from utils.geocoding import GEOCODE_CACHE_TTL
+
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+ACTIVE_USERS_TTL = 90 * 24 * 60 * 60
+
+INDEXES = [
+    ("buildings_collection", [("location", GEOSPHERE)], {}),
+    ("buildings_collection", [("id", ASCENDING)], {"unique": True}),
+    ("buildings_collection", [("link", ASCENDING)], {"unique": True}),
+    ("users", [("id", ASCENDING)], {"unique": True}),
+    ("users", [("blocked_at", ASCENDING)], {"sparse": True}),
+    ("mailings", [("status", ASCENDING)], {}),
+    ("stats_active_users", [("day", ASCENDING)], {}),
+]
+
+HOT_QUERIES = [
+    ("buildings_collection", {"id": ""}),
+    ("buildings_collection", {"id": {"$in": [""]}}),
+    ("buildings_collection", {"link": ""}),
+    ("users", {"id": 0}),
+    ("users", {"blocked_at": {"$gte": datetime.min}}),
+    ("mailings", {"status": "running"}),
+    ("stats_active_users", {"day": ""}),
+]
+
+
+async def create_indexes():
+    for collection_name, keys, options in INDEXES:
+        collection = await MongoDB().get_collection(collection_name)
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            logging.error(f"Failed to create index {keys} on {collection_name}: {str(e)}")
+
+
+async def create_ttl_indexes(ttl_indexes: list):
+    """
+    Create the TTL indexes, or change the expiry of the existing ones.
+
+    Args:
+        ttl_indexes: (collection name, field, seconds) tuples.
+    """
+    for collection_name, field, ttl in ttl_indexes:
+        collection = await MongoDB().get_collection(collection_name)
+        try:
+            await collection.create_index(field, expireAfterSeconds=ttl)
+        except OperationFailure as e:
+            if e.code not in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT):
+                raise
+            await collection.database.command(
+                "collMod",
+                collection_name,
+                index={"keyPattern": {field: 1}, "expireAfterSeconds": ttl},
+            )
+            logging.info(f"TTL of {collection_name}.{field} changed to {ttl}s")
+
+
+def find_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(find_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(find_collscan(value) for value in plan)
+    return False
+
+
+async def verify_query_plans(strict: bool = False):
+    """
+    Explain every query in HOT_QUERIES and report the ones whose winning plan
+    scans the whole collection.
+
+    Args:
+        strict: Raise instead of logging when a query scans its collection.
+    """
+    collscans = []
+    for collection_name, query in HOT_QUERIES:
+        collection = await MongoDB().get_collection(collection_name)
+        explanation = await collection.find(query).explain()
+        if find_collscan(explanation["queryPlanner"]["winningPlan"]):
+            collscans.append(f"{collection_name} {query}")
+
+    if not collscans:
+        logging.info("All hot queries use indexes")
+        return
+
+    report = "Hot queries scan whole collections: " + "; ".join(collscans)
+    if strict:
+        raise RuntimeError(report)
+    logging.error(report)
+
+
+async def bootstrap_indexes(fsm_ttl: Optional[float] = None, strict: bool = False):
+    """
+    Create the indexes of all collections and verify the hot queries use them.
+
+    Args:
+        fsm_ttl: Seconds after which idle FSM records expire, None to keep them.
+        strict: Fail instead of logging when a hot query scans its collection.
+    """
+    ttl_indexes = [
+        ("geocode_cache", "created_at", GEOCODE_CACHE_TTL),
+        ("stats_active_users", "created_at", ACTIVE_USERS_TTL),
+    ]
+    if fsm_ttl:
+        ttl_indexes.append((FSM_COLLECTION, "updated_at", int(fsm_ttl)))
+
+    await create_indexes()
+    await create_ttl_indexes(ttl_indexes)
+    await verify_query_plans(strict)
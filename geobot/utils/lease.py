@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+from utils.db import MongoDB
+
+LEASE_TTL = 60
+
+
+class Lease:
+    """
+    Named lock shared by all worker processes through the leases collection.
+
+    Whoever acquires the lease keeps renewing it in the background until it is
+    released. A lease whose holder died is taken over once it expires, after
+    LEASE_TTL seconds. Every Lease object is a separate owner, so a job guarded
+    by a lease cannot run twice even within one process.
+    """
+
+    def __init__(self, name: str, ttl: float = LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.owner = uuid.uuid4().hex
+        self.task = None
+
+    async def acquire(self) -> bool:
+        collection = await MongoDB().get_collection("leases")
+        now = datetime.now(timezone.utc)
+        try:
+            await collection.update_one(
+                {
+                    "_id": self.name,
+                    "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}],
+                },
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.ttl)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+
+        if self.task is None:
+            self.task = asyncio.create_task(self._renew_periodically())
+        return True
+
+    async def release(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        collection = await MongoDB().get_collection("leases")
+        await collection.delete_one({"_id": self.name, "owner": self.owner})
+
+    async def run(self, coroutine):
+        """
+        Await the coroutine and release the lease once it finishes.
+        """
+        try:
+            return await coroutine
+        finally:
+            await self.release()
+
+    async def _renew_periodically(self):
+        collection = await MongoDB().get_collection("leases")
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                result = await collection.update_one(
+                    {"_id": self.name, "owner": self.owner},
+                    {
+                        "$set": {
+                            "expires_at": datetime.now(timezone.utc)
+                            + timedelta(seconds=self.ttl)
+                        }
+                    },
+                )
+                if not result.matched_count:
+                    logging.error(f"Lease {self.name} was lost")
+            except Exception as e:
+                logging.warning(f"Failed to renew lease {self.name}: {str(e)}")
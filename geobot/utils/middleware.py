@@ -3,6 +3,7 @@ from aiogram.dispatcher import Dispatcher
 from aiogram.dispatcher.handler import CancelHandler
 from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.utils.exceptions import Throttled
+from utils.outbound import Priority, current_priority
 
 
 class RateLimitingMiddleware(BaseMiddleware):
@@ -14,4 +15,19 @@ class RateLimitingMiddleware(BaseMiddleware):
             await dp.throttle(user_id, rate=1)
         except Throttled:
             await message.reply("Слишком много запросов")
-            raise CancelHandler()
\ No newline at end of file
+            raise CancelHandler()
+
+
+class PriorityMiddleware(BaseMiddleware):
+    """
+    Sets the outbound priority of the replies sent while an update is handled.
+    """
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        current_priority.set(Priority.INTERACTIVE)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        current_priority.set(Priority.REPLY)
+
+    async def on_pre_process_edited_message(self, message: types.Message, data: dict):
+        current_priority.set(Priority.LIVE)
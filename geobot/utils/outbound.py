@@ -0,0 +1,185 @@
+import asyncio
+import itertools
+import logging
+from contextvars import ContextVar
+from enum import IntEnum
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+OUTBOUND_MAX_RETRIES = 3
+MAX_IDLE_CHAT_BUCKETS = 10000
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    REPLY = 1
+    LIVE = 2
+    MAILING = 3
+
+
+current_priority = ContextVar("current_priority", default=Priority.REPLY)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = 0
+        self.paused_until = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """
+        Seconds until a token is available, 0 if one is available now.
+        """
+        self._refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class OutboundScheduler:
+    """
+    Grants permission to send to a chat, highest priority first.
+
+    Every send takes a token from the global bucket and from the bucket of its
+    chat. Waiters whose chat is out of tokens are skipped, so one busy chat
+    does not hold back the others.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.wakeup = None
+        self.task = None
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, priority: Priority, chat_id):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._dispatch())
+
+        future = loop.create_future()
+        self.waiters.append((priority, next(self.sequence), chat_id, future))
+        self.wakeup.set()
+        await future
+
+    def pause(self, chat_id, seconds: float, everyone: bool = False):
+        """
+        Hold back sends to the chat, or to all chats if everyone is set, for seconds.
+        """
+        loop = asyncio.get_running_loop()
+        buckets = [self._chat_bucket(chat_id)]
+        if everyone:
+            buckets.append(self.global_bucket)
+        for bucket in buckets:
+            bucket.paused_until = max(bucket.paused_until, loop.time() + seconds)
+        self.wakeup.set()
+
+    async def _sleep(self, delay: float):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.waiters = [waiter for waiter in self.waiters if not waiter[3].done()]
+            if not self.waiters:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = loop.time()
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                await self._sleep(global_delay)
+                continue
+
+            chosen, earliest = None, float("inf")
+            for waiter in sorted(self.waiters):
+                chat_delay = self._chat_bucket(waiter[2]).delay(now)
+                if chat_delay <= 0:
+                    chosen = waiter
+                    break
+                earliest = min(earliest, chat_delay)
+
+            if chosen is None:
+                await self._sleep(earliest)
+                continue
+
+            self.waiters.remove(chosen)
+            self.global_bucket.consume(now)
+            self._chat_bucket(chosen[2]).consume(now)
+            chosen[3].set_result(None)
+
+            if len(self.chat_buckets) > MAX_IDLE_CHAT_BUCKETS:
+                self.chat_buckets = {
+                    chat_id: bucket
+                    for chat_id, bucket in self.chat_buckets.items()
+                    if not bucket.is_idle(now)
+                }
+
+
+class ScheduledBot(Bot):
+    """
+    Bot whose requests to a chat go through the OutboundScheduler.
+
+    The priority comes from current_priority, which PriorityMiddleware sets per
+    update type and the broadcaster sets for mailings. RetryAfter answers pause
+    the chat and the request is retried here, so callers never handle them.
+    Mailings and live locations send about one message per chat, so their
+    RetryAfter means the bot-wide limit was hit and pauses all chats.
+    Requests without chat_id, such as getUpdates or answerCallbackQuery, are not queued.
+    """
+
+    def __init__(self, *args, global_rate: float = GLOBAL_RATE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = OutboundScheduler(global_rate=global_rate)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        chat_id = (data or {}).get("chat_id")
+        if chat_id is None:
+            return await super().request(method, data, files, **kwargs)
+
+        priority = current_priority.get()
+        for attempt in range(OUTBOUND_MAX_RETRIES):
+            await self.scheduler.acquire(priority, chat_id)
+            try:
+                return await super().request(method, data, files, **kwargs)
+            except RetryAfter as e:
+                if files or attempt + 1 == OUTBOUND_MAX_RETRIES:
+                    raise
+                everyone = priority >= Priority.LIVE
+                logging.warning(
+                    f"Flood control for {'all chats' if everyone else f'chat {chat_id}'}, "
+                    f"retry in {e.timeout}s"
+                )
+                self.scheduler.pause(chat_id, e.timeout, everyone)
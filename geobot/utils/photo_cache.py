@@ -0,0 +1,93 @@
+import logging
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import BadRequest
+from utils.db import MongoDB, SingletonMeta
+from utils.outbound import Priority, current_priority
+
+
+class PhotoCache(metaclass=SingletonMeta):
+    """
+    Telegram file_id of every building photo that was already sent.
+
+    Once Telegram has fetched an image, later cards send its file_id instead of
+    the URL, so the image is not downloaded from the origin host again.
+    The ids live in memory and in the photo_cache collection, keyed by building id
+    together with the image URL, so a changed image in Notion is fetched anew.
+    """
+
+    def __init__(self):
+        self.file_ids = {}
+
+    async def load(self):
+        collection = await MongoDB().get_collection("photo_cache")
+        self.file_ids = {
+            document["_id"]: (document["image"], document["file_id"])
+            async for document in collection.find({})
+        }
+
+    def get(self, building_id: str, image: str) -> str:
+        cached = self.file_ids.get(building_id)
+        if cached and cached[0] == image:
+            return cached[1]
+        return image
+
+    async def remember(self, building_id: str, image: str, message):
+        if not isinstance(message, types.Message) or not message.photo:
+            return
+
+        file_id = message.photo[-1].file_id
+        if self.file_ids.get(building_id) == (image, file_id):
+            return
+
+        self.file_ids[building_id] = (image, file_id)
+        collection = await MongoDB().get_collection("photo_cache")
+        await collection.update_one(
+            {"_id": building_id},
+            {"$set": {"image": image, "file_id": file_id}},
+            upsert=True,
+        )
+
+    async def send(self, building_id: str, image: str, send_photo):
+        """
+        Call send_photo with the cached file_id or the image URL and remember
+        the file_id Telegram returns. A file_id Telegram no longer accepts is
+        dropped and the URL is sent instead.
+
+        Args:
+            send_photo: Function that takes the photo and returns the bot API call.
+        """
+        photo = self.get(building_id, image)
+        try:
+            message = await send_photo(photo)
+        except BadRequest as e:
+            if photo == image:
+                raise
+            logging.warning(f"Cached photo of {building_id} rejected: {str(e)}")
+            self.file_ids.pop(building_id, None)
+            message = await send_photo(image)
+
+        await self.remember(building_id, image, message)
+        return message
+
+    async def prewarm(self, bot: Bot, chat_id: int, buildings: list):
+        """
+        Upload the images that have no file_id yet by sending them to chat_id
+        and deleting the messages right away.
+        """
+        current_priority.set(Priority.MAILING)
+        uploaded = 0
+        for building in buildings:
+            image = building.get("image")
+            if not image or self.get(building["id"], image) != image:
+                continue
+
+            try:
+                message = await bot.send_photo(chat_id, image, disable_notification=True)
+                await self.remember(building["id"], image, message)
+                await bot.delete_message(chat_id, message.message_id)
+                uploaded += 1
+            except Exception as e:
+                logging.warning(f"Failed to prewarm photo of {building['id']}: {str(e)}")
+
+        logging.info(f"Photo cache prewarmed: {uploaded} images uploaded")
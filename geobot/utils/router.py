@@ -0,0 +1,154 @@
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+from typing import Optional
+
+from aiohttp import ClientSession, ClientTimeout, web
+from utils.webhook import SECRET_TOKEN_HEADER
+
+WORKER_RESTART_DELAY = 5
+FORWARD_TIMEOUT = 60
+
+
+def get_update_user_id(update: dict) -> Optional[int]:
+    """
+    Id of the user an update comes from, or of its chat if it has no sender.
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        for sender_key in ("from", "user"):
+            if isinstance(value.get(sender_key), dict):
+                return value[sender_key]["id"]
+        if isinstance(value.get("chat"), dict):
+            return value["chat"]["id"]
+    return None
+
+
+class UpdateRouter:
+    """
+    Webhook endpoint that forwards every update to the worker owning its user.
+
+    A user always maps to the same worker, so the worker's cached FSM data,
+    throttling buckets and live location state stay valid. Updates of one
+    user are forwarded one at a time, in the order they arrived, while updates
+    of different users are forwarded concurrently.
+    """
+
+    def __init__(self, worker_urls: list, secret_token: Optional[str] = None):
+        self.worker_urls = worker_urls
+        self.secret_token = secret_token
+        self.session = None
+        self.locks = {}
+
+    def worker_url(self, user_id: Optional[int]) -> str:
+        return self.worker_urls[(user_id or 0) % len(self.worker_urls)]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token and request.headers.get(SECRET_TOKEN_HEADER) != self.secret_token:
+            raise web.HTTPUnauthorized()
+
+        body = await request.read()
+        user_id = get_update_user_id(json.loads(body))
+        url = self.worker_url(user_id)
+
+        lock, waiters = self.locks.get(user_id, (asyncio.Lock(), 0))
+        self.locks[user_id] = (lock, waiters + 1)
+        try:
+            async with lock:
+                return await self._forward(url, body)
+        finally:
+            lock, waiters = self.locks[user_id]
+            if waiters == 1:
+                del self.locks[user_id]
+            else:
+                self.locks[user_id] = (lock, waiters - 1)
+
+    async def _forward(self, url: str, body: bytes) -> web.Response:
+        headers = {"Content-Type": "application/json"}
+        if self.secret_token:
+            headers[SECRET_TOKEN_HEADER] = self.secret_token
+
+        async with self.session.post(url, data=body, headers=headers) as response:
+            return web.Response(
+                body=await response.read(),
+                status=response.status,
+                content_type=response.content_type,
+            )
+
+    async def on_startup(self, app: web.Application):
+        self.session = ClientSession(timeout=ClientTimeout(total=FORWARD_TIMEOUT))
+
+    async def on_cleanup(self, app: web.Application):
+        await self.session.close()
+
+
+class WorkerPool:
+    """
+    Runs the bot workers as child processes in webhook mode, one port each,
+    and restarts a worker that exits.
+    """
+
+    def __init__(self, workers: int, host: str, base_port: int):
+        self.workers = workers
+        self.host = host
+        self.base_port = base_port
+        self.processes = {}
+        self.task = None
+
+    @property
+    def ports(self) -> list:
+        return [self.base_port + worker_id for worker_id in range(self.workers)]
+
+    def _spawn(self, worker_id: int):
+        env = {
+            **os.environ,
+            "BOT_MODE": "webhook",
+            "WORKERS": str(self.workers),
+            "WORKER_ID": str(worker_id),
+            "WEBAPP_HOST": self.host,
+            "WEBAPP_PORT": str(self.base_port + worker_id),
+        }
+        self.processes[worker_id] = subprocess.Popen([sys.executable, sys.argv[0]], env=env)
+        logging.info(f"Worker {worker_id} started on port {self.base_port + worker_id}")
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            for worker_id, process in list(self.processes.items()):
+                if process.poll() is not None:
+                    logging.error(f"Worker {worker_id} exited with {process.returncode}, restarting")
+                    self._spawn(worker_id)
+
+    async def health(self, request: web.Request) -> web.Response:
+        alive = sum(process.poll() is None for process in self.processes.values())
+        return web.json_response(
+            {"status": "ok" if alive == self.workers else "degraded", "workers": alive}
+        )
+
+    async def on_startup(self, app: web.Application):
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+        self.task = asyncio.create_task(self._supervise())
+
+    async def on_cleanup(self, app: web.Application):
+        self.task.cancel()
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.wait()
+
+
+def create_router_app(pool: WorkerPool, path: str, secret_token: Optional[str] = None) -> web.Application:
+    router = UpdateRouter(
+        [f"http://{pool.host}:{port}{path}" for port in pool.ports], secret_token
+    )
+    app = web.Application()
+    app.router.add_post(path, router.handle)
+    app.router.add_get("/health", pool.health)
+    app.on_startup.extend([pool.on_startup, router.on_startup])
+    app.on_cleanup.extend([router.on_cleanup, pool.on_cleanup])
+    return app
@@ -0,0 +1,66 @@
+import logging
+from collections import Counter, defaultdict
+
+from utils.db import SingletonMeta
+from utils.gazetteer import normalize_query
+
+NAME_MATCH_THRESHOLD = 0.5
+MAX_SEARCH_RESULTS = 10
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class BuildingsSearchIndex(metaclass=SingletonMeta):
+    """
+    In-memory search over the buildings' names.
+
+    Names are matched fuzzily by trigram similarity. The texts are
+    not searched: a place mentioned in a description, like a nearby metro
+    station, is not where the building is, so such a query is geocoded instead.
+    The index is rebuilt every time BuildingsIndex loads the buildings.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.names = []
+        self.name_postings = defaultdict(set)
+
+    def build(self, buildings: list):
+        ids, names = [], []
+        name_postings = defaultdict(set)
+
+        for position, building in enumerate(buildings):
+            name = building.get("name")
+            name_trigrams = trigrams(normalize_query(name)) if name else set()
+            ids.append(building["id"])
+            names.append(name_trigrams)
+
+            for trigram in name_trigrams:
+                name_postings[trigram].add(position)
+
+        self.ids, self.names, self.name_postings = ids, names, name_postings
+        logging.info(f"Buildings search index built: {len(ids)} buildings")
+
+    def search(self, query: str) -> list:
+        """
+        Ids of the buildings matching the query, best match first.
+        """
+        query = normalize_query(query)
+        query_trigrams = trigrams(query)
+
+        hits = Counter()
+        for trigram in query_trigrams:
+            hits.update(self.name_postings.get(trigram, ()))
+
+        scores = {}
+        for position, common in hits.items():
+            similarity = common / len(query_trigrams | self.names[position])
+            if similarity >= NAME_MATCH_THRESHOLD:
+                scores[position] = similarity
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:MAX_SEARCH_RESULTS]
+        return [self.ids[position] for position in ranked]
+
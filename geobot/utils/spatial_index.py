@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import math
+
+import numpy as np
+from utils.db import MongoDB, SingletonMeta
+
+EARTH_RADIUS_KM = 6378.1
+BATCH_ROWS = 256
+DATASET_VERSION_ID = "buildings_dataset"
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Great-circle distance between two points in kilometres.
+
+    Uses the same earth radius as MongoDB's spherical $geoNear, so distances
+    match the ones the aggregation pipeline returns.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = (
+        math.sin(d_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_matrix(
+    lats: np.ndarray, lons: np.ndarray, table_lats: np.ndarray, table_lons: np.ndarray
+) -> np.ndarray:
+    """
+    Distances in kilometres from every query point to every table point.
+
+    All coordinates are in radians.
+
+    Returns:
+        np.ndarray: Matrix of len(lats) rows and len(table_lats) columns.
+    """
+    d_phi = table_lats[np.newaxis, :] - lats[:, np.newaxis]
+    d_lambda = table_lons[np.newaxis, :] - lons[:, np.newaxis]
+    a = (
+        np.sin(d_phi / 2) ** 2
+        + np.cos(lats)[:, np.newaxis]
+        * np.cos(table_lats)[np.newaxis, :]
+        * np.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def safe_margin(inside: list, nearest: list, radius: float) -> float:
+    """
+    Distance the user can move without changing the live-location answer.
+
+    The answer changes only when a building outside the radius comes into it,
+    or when the second closest building overtakes the closest one.
+
+    Args:
+        inside: (distance, building) tuples within the radius, closest first.
+        nearest: At least len(inside) + 1 closest (distance, building) tuples.
+    """
+    margins = []
+    if len(nearest) > len(inside):
+        margins.append(nearest[len(inside)][0] - radius)
+    if len(inside) > 1:
+        margins.append((inside[1][0] - inside[0][0]) / 2)
+
+    return max(0, min(margins)) if margins else 0
+
+
+class BuildingsIndex(metaclass=SingletonMeta):
+    """
+    In-process table of buildings_collection for distance queries.
+
+    The coordinates are kept in NumPy arrays sorted by latitude, parallel to
+    the list of building documents. A query takes the slice of buildings in the
+    latitude band of its radius with searchsorted and computes their distances,
+    filters and ranks them with vectorized operations, for one point or for a
+    batch of points at once. The collection stays the source of truth:
+    the index is rebuilt from it on startup and after every Notion refresh.
+    Structures derived from the buildings subscribe with add_listener and are
+    rebuilt on every load. A refresh bumps the dataset version in sync_state
+    with publish, and the other workers reload once they see the new version.
+    """
+
+    def __init__(self):
+        self.buildings = []
+        self.lats = np.empty(0)
+        self.lons = np.empty(0)
+        self.by_id = {}
+        self.loaded = False
+        self.listeners = []
+        self.version = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    async def load(self):
+        try:
+            version = await self._get_version()
+            collection = await MongoDB().get_collection("buildings_collection")
+            buildings = await collection.find({}, {"_id": 0}).to_list(length=None)
+        except Exception as e:
+            logging.error(f"Failed to load buildings index: {str(e)}")
+            return False
+
+        self.build(buildings)
+        self.version = version
+        logging.info(f"Buildings index loaded: {len(buildings)} buildings, version {version}")
+
+        for listener in self.listeners:
+            listener(self.buildings)
+        return True
+
+    def build(self, buildings: list):
+        """
+        Replace the table with the buildings, sorted by latitude.
+        """
+        buildings = sorted(buildings, key=lambda building: building["location"]["coordinates"][1])
+        coordinates = np.radians(
+            np.array(
+                [building["location"]["coordinates"] for building in buildings],
+                dtype=float,
+            ).reshape(-1, 2)
+        )
+
+        self.buildings = buildings
+        self.lons, self.lats = coordinates[:, 0].copy(), coordinates[:, 1].copy()
+        self.by_id = {building["id"]: building for building in buildings}
+        self.loaded = True
+
+    async def _get_version(self):
+        collection = await MongoDB().get_collection("sync_state")
+        state = await collection.find_one({"_id": DATASET_VERSION_ID})
+        return state["version"] if state else 0
+
+    async def publish(self):
+        """
+        Bump the dataset version after the collection changed and reload.
+        """
+        collection = await MongoDB().get_collection("sync_state")
+        await collection.update_one(
+            {"_id": DATASET_VERSION_ID}, {"$inc": {"version": 1}}, upsert=True
+        )
+        return await self.load()
+
+    async def watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await self._get_version() != self.version:
+                    await self.load()
+            except Exception as e:
+                logging.error(f"Failed to check buildings dataset version: {str(e)}")
+
+    def _band(self, min_lat: float, max_lat: float) -> slice:
+        """
+        Slice of the table with latitudes between min_lat and max_lat radians.
+        """
+        start = np.searchsorted(self.lats, min_lat, side="left")
+        stop = np.searchsorted(self.lats, max_lat, side="right")
+        return slice(start, stop)
+
+    def query_radius_many(
+        self, points: list, radius: float, limit: int = None
+    ) -> list[list[tuple]]:
+        """
+        Buildings within radius kilometres of each of the points.
+
+        Args:
+            points (list): (latitude, longitude) tuples in degrees.
+            limit (int): Keep only that many closest buildings per point.
+
+        Returns:
+            list: For every point, (distance in km, building document) tuples sorted by distance.
+        """
+        if not points or not self.buildings:
+            return [[] for _ in points]
+
+        query = np.radians(np.array(points, dtype=float).reshape(-1, 2))
+        span = radius / EARTH_RADIUS_KM
+        band = self._band(query[:, 0].min() - span, query[:, 0].max() + span)
+        band_lats, band_lons = self.lats[band], self.lons[band]
+
+        results = []
+        for row in range(0, len(query), BATCH_ROWS):
+            rows = query[row : row + BATCH_ROWS]
+            distances = haversine_matrix(rows[:, 0], rows[:, 1], band_lats, band_lons)
+            for row_distances in distances:
+                inside = np.flatnonzero(row_distances <= radius)
+                order = inside[np.argsort(row_distances[inside], kind="stable")][:limit]
+                results.append(
+                    [
+                        (distance, self.buildings[band.start + position])
+                        for distance, position in zip(
+                            row_distances[order].tolist(), order.tolist()
+                        )
+                    ]
+                )
+        return results
+
+    def query_radius(self, lat: float, lon: float, radius: float, limit: int = None) -> list[tuple]:
+        """
+        Buildings within radius kilometres of the point.
+
+        Returns:
+            list: (distance in km, building document) tuples sorted by distance.
+        """
+        return self.query_radius_many([(lat, lon)], radius, limit)[0]
+
+    def query_nearest_many(self, points: list, limit: int = 1) -> list[list[tuple]]:
+        """
+        The limit closest buildings to each of the points regardless of radius.
+        """
+        if not points or not self.buildings:
+            return [[] for _ in points]
+
+        query = np.radians(np.array(points, dtype=float).reshape(-1, 2))
+        limit = min(limit, len(self.buildings))
+
+        results = []
+        for row in range(0, len(query), BATCH_ROWS):
+            rows = query[row : row + BATCH_ROWS]
+            distances = haversine_matrix(rows[:, 0], rows[:, 1], self.lats, self.lons)
+            closest = np.argpartition(distances, limit - 1, axis=1)[:, :limit]
+            for row_distances, row_closest in zip(distances, closest):
+                order = row_closest[np.argsort(row_distances[row_closest], kind="stable")]
+                results.append(
+                    [
+                        (distance, self.buildings[position])
+                        for distance, position in zip(
+                            row_distances[order].tolist(), order.tolist()
+                        )
+                    ]
+                )
+        return results
+
+    def query_nearest(self, lat: float, lon: float, limit: int = 1) -> list[tuple]:
+        """
+        The limit closest buildings regardless of radius.
+        """
+        return self.query_nearest_many([(lat, lon)], limit)[0]
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from pymongo import UpdateOne
+from utils.db import MongoDB, SingletonMeta
+from utils.spatial_index import BuildingsIndex
+
+STATS_TIMEZONE = timezone(timedelta(hours=3))
+EVENTS = ("start", "location", "search", "view", "save")
+
+
+def get_day(moment: datetime) -> str:
+    return moment.astimezone(STATS_TIMEZONE).strftime("%Y-%m-%d")
+
+
+def get_hour(moment: datetime) -> str:
+    return moment.astimezone(STATS_TIMEZONE).strftime("%Y-%m-%dT%H")
+
+
+class UsageStats(metaclass=SingletonMeta):
+    """
+    Write-behind rollups of the bot's usage.
+
+    Events are counted in memory and added to the rollup documents with $inc
+    upserts every flush interval: stats_hourly holds the event counters of an
+    hour, stats_daily those of a day together with the views per building and
+    per layer. A user active on a day gets one document in stats_active_users,
+    inserted once per day by every worker, so the DAU is an indexed count.
+    /stats reads only these small documents.
+    """
+
+    def __init__(self):
+        self.hourly = Counter()
+        self.daily = Counter()
+        self.active_users = set()
+        self.seen_users = set()
+        self.seen_day = None
+        self.task = None
+
+    def start(self, interval: float):
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_periodically(interval))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def _flush_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def record(self, event: str, user_id: Optional[int] = None, building_id: Optional[str] = None):
+        now = datetime.now(timezone.utc)
+        day, hour = get_day(now), get_hour(now)
+
+        self.hourly[(hour, f"events.{event}")] += 1
+        self.daily[(day, f"events.{event}")] += 1
+
+        if building_id is not None:
+            self.daily[(day, f"buildings.{building_id}.{event}")] += 1
+            building = BuildingsIndex().by_id.get(building_id)
+            if building is not None and building.get("layer"):
+                layer = building["layer"].replace(".", "_").replace("$", "_")
+                self.daily[(day, f"layers.{layer}.{event}")] += 1
+
+        if user_id is not None:
+            if self.seen_day != day:
+                self.seen_day = day
+                self.seen_users = set()
+            if user_id not in self.seen_users:
+                self.seen_users.add(user_id)
+                self.active_users.add((day, user_id))
+
+    @staticmethod
+    def _increments(counters: Counter) -> list:
+        increments = {}
+        for (document_id, field), count in counters.items():
+            increments.setdefault(document_id, {})[field] = count
+        return [
+            UpdateOne({"_id": document_id}, {"$inc": fields}, upsert=True)
+            for document_id, fields in increments.items()
+        ]
+
+    async def flush(self):
+        hourly, self.hourly = self.hourly, Counter()
+        daily, self.daily = self.daily, Counter()
+        active_users, self.active_users = self.active_users, set()
+
+        try:
+            if hourly:
+                collection = await MongoDB().get_collection("stats_hourly")
+                await collection.bulk_write(self._increments(hourly), ordered=False)
+                hourly = Counter()
+            if daily:
+                collection = await MongoDB().get_collection("stats_daily")
+                await collection.bulk_write(self._increments(daily), ordered=False)
+                daily = Counter()
+            if active_users:
+                now = datetime.now(timezone.utc)
+                collection = await MongoDB().get_collection("stats_active_users")
+                await collection.bulk_write(
+                    [
+                        UpdateOne(
+                            {"_id": f"{day}:{user_id}"},
+                            {"$setOnInsert": {"day": day, "created_at": now}},
+                            upsert=True,
+                        )
+                        for day, user_id in active_users
+                    ],
+                    ordered=False,
+                )
+                active_users = set()
+        except Exception as e:
+            logging.error(f"Failed to flush usage stats: {str(e)}")
+            self.hourly.update(hourly)
+            self.daily.update(daily)
+            self.active_users |= active_users
+
+    async def get_daily_active_users(self, day: str) -> int:
+        collection = await MongoDB().get_collection("stats_active_users")
+        return await collection.count_documents({"day": day})
+
+    async def get_days(self, days: int) -> list:
+        """
+        The daily rollups of the last days, today included.
+        """
+        today = datetime.now(timezone.utc)
+        ids = [get_day(today - timedelta(days=offset)) for offset in range(days)]
+        collection = await MongoDB().get_collection("stats_daily")
+        return await collection.find({"_id": {"$in": ids}}).to_list(length=None)
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from pymongo import UpdateOne
+from utils.db import MongoDB, SingletonMeta
+
+BLOCKED_CHECK_OVERLAP = timedelta(minutes=1)
+
+
+class UserRegistry(metaclass=SingletonMeta):
+    """
+    In-memory registry of the users who have started the bot.
+
+    The ids of all users, and of those whom a mailing marked as blocked, are
+    loaded on startup, so a repeated /start is answered from memory. A first-seen
+    user is remembered at once and written to the users collection in the next
+    batch: one upsert per user that only sets the id and the first-seen time on
+    insert, so workers registering the same user do not create duplicates.
+    A /start of a blocked user queues an update that unblocks them. Mailings can
+    run on any worker, so users blocked since the last check are read with one
+    indexed query on blocked_at every flush interval.
+    """
+
+    def __init__(self):
+        self.known = set()
+        self.blocked = set()
+        self.blocked_checked_at = None
+        self.pending = {}
+        self.task = None
+
+    async def load(self):
+        collection = await MongoDB().get_collection("users")
+        checked_at = datetime.now(timezone.utc)
+        known, blocked = set(), set()
+        async for user in collection.find({}, {"_id": 0, "id": 1, "blocked": 1}):
+            known.add(user["id"])
+            if user.get("blocked"):
+                blocked.add(user["id"])
+        self.known, self.blocked = known, blocked
+        self.blocked_checked_at = checked_at
+        logging.info(f"User registry loaded: {len(known)} users, {len(blocked)} blocked")
+
+    def start(self, interval: float):
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_periodically(interval))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def _flush_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_blocked()
+            except Exception as e:
+                logging.error(f"Failed to read blocked users: {str(e)}")
+            await self.flush()
+
+    async def refresh_blocked(self):
+        """
+        Add the users that mailings on any worker marked as blocked since the last check.
+        """
+        checked_at = datetime.now(timezone.utc)
+        since = (self.blocked_checked_at or checked_at) - BLOCKED_CHECK_OVERLAP
+        collection = await MongoDB().get_collection("users")
+        async for user in collection.find(
+            {"blocked_at": {"$gte": since}}, {"_id": 0, "id": 1, "blocked": 1}
+        ):
+            if user.get("blocked") and user["id"] not in self.pending:
+                self.blocked.add(user["id"])
+        self.blocked_checked_at = checked_at
+
+    def register(self, user_id: int):
+        if user_id in self.blocked:
+            self.blocked.discard(user_id)
+            self.pending.setdefault(user_id, None)
+            return
+
+        if user_id in self.known:
+            return
+
+        self.known.add(user_id)
+        self.pending[user_id] = datetime.now(timezone.utc)
+
+    async def flush(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+        operations = [
+            UpdateOne(
+                {"id": user_id},
+                {
+                    "$setOnInsert": {"first_seen": first_seen},
+                    "$unset": {"blocked": "", "blocked_at": ""},
+                },
+                upsert=True,
+            )
+            if first_seen is not None
+            else UpdateOne({"id": user_id}, {"$unset": {"blocked": "", "blocked_at": ""}})
+            for user_id, first_seen in pending.items()
+        ]
+
+        try:
+            collection = await MongoDB().get_collection("users")
+            await collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logging.error(f"Failed to register users: {str(e)}")
+            for user_id, first_seen in pending.items():
+                if self.pending.get(user_id) is None:
+                    self.pending[user_id] = first_seen
@@ -1,12 +1,25 @@
+import asyncio
 import logging
 import os
 
-from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram import Dispatcher
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from dotenv.main import load_dotenv
+from utils.broadcast import Broadcaster
 from utils.db import MongoDB
-from utils.middleware import RateLimitingMiddleware
+from utils.fsm_storage import CachedMongoStorage
+from utils.gazetteer import Gazetteer
+from utils.geocoding import Geocoder
+from utils.indexes import bootstrap_indexes
+from utils.middleware import PriorityMiddleware, RateLimitingMiddleware
+from utils.outbound import GLOBAL_RATE, ScheduledBot
+from utils.photo_cache import PhotoCache
+from utils.search_index import BuildingsSearchIndex
+from utils.spatial_index import BuildingsIndex
+from utils.usage_stats import UsageStats
+from utils.user_registry import UserRegistry
+from utils.views_counter import ViewsCounter
+from utils.webhook import register_webhook
 
 load_dotenv()
 
@@ -20,8 +33,31 @@ ADMIN_GROUP_ID = int(os.getenv("ADMIN_GROUP_ID"))
 NOTION_API_TOKEN = os.getenv("NOTION_API_TOKEN")
 NOTION_DB = os.getenv("NOTION_DB")
 
-storage = MemoryStorage()
-bot = Bot(token=BOT_API_TOKEN)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 40))
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "127.0.0.1")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+WORKERS = int(os.getenv("WORKERS", 1))
+WORKER_ID = int(os.getenv("WORKER_ID", 0))
+DATASET_POLL_INTERVAL = 10
+
+VIEWS_FLUSH_INTERVAL = float(os.getenv("VIEWS_FLUSH_INTERVAL", 30))
+USERS_FLUSH_INTERVAL = 5
+STATS_FLUSH_INTERVAL = 30
+STATS_PERIOD_DAYS = 7
+STATS_TOP_BUILDINGS = 10
+REFRESH_PROGRESS_INTERVAL = 5
+PHOTO_PREWARM = os.getenv("PHOTO_PREWARM", "0") == "1"
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 5))
+FSM_TTL = float(os.getenv("FSM_TTL")) if os.getenv("FSM_TTL") else None
+STRICT_INDEX_CHECK = os.getenv("STRICT_INDEX_CHECK", "0") == "1"
+
+storage = CachedMongoStorage(FSM_FLUSH_INTERVAL)
+bot = ScheduledBot(token=BOT_API_TOKEN, global_rate=GLOBAL_RATE / WORKERS)
 dp = Dispatcher(bot, storage=storage)
 
 
@@ -30,6 +66,23 @@ class UserStates(StatesGroup):
     
 DYNAMIC_RADIUS = 0.1
 STATIC_RADIUS = 0.5
+CLOSEST_BUILDINGS_LIMIT = 100
+MAX_CAROUSELS = 10
+LIVE_MIN_DISPLACEMENT = float(os.getenv("LIVE_MIN_DISPLACEMENT", 0.02))
+LIVE_TICK_INTERVAL = float(os.getenv("LIVE_TICK_INTERVAL", 0.5))
+
+EXAMPLE_PLACES = [
+    "Улица Солянка, Москва",
+    "Даниловский монастырь",
+    "Бутырская тюрьма",
+    "Камергерский переулок, 2",
+    "Лубянская площадь",
+    "Таганская улица",
+    "Петровка, 38",
+    "Метро Чистые пруды",
+    "МГУ",
+    "Улица Воздвиженка",
+]
 
 
 async def on_startup(dp):
@@ -37,14 +90,50 @@ async def on_startup(dp):
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=LOG_LEVEL, filename=LOG_PATH, filemode="a"
     )
     await MongoDB().connect()
+    await bootstrap_indexes(fsm_ttl=FSM_TTL, strict=STRICT_INDEX_CHECK)
+    storage.start()
+    BuildingsIndex().add_listener(BuildingsSearchIndex().build)
+    BuildingsIndex().add_listener(ViewsCounter().reset_counts)
+    await BuildingsIndex().load()
+    asyncio.create_task(BuildingsIndex().watch(DATASET_POLL_INTERVAL))
+    ViewsCounter().start(VIEWS_FLUSH_INTERVAL)
+    await UserRegistry().load()
+    UserRegistry().start(USERS_FLUSH_INTERVAL)
+    UsageStats().start(STATS_FLUSH_INTERVAL)
+    await PhotoCache().load()
+    Gazetteer().load()
+    Geocoder().setup(workers=WORKERS)
+    dp.middleware.setup(PriorityMiddleware())
     dp.middleware.setup(RateLimitingMiddleware())
-    await dp.bot.send_message(
-        chat_id=ADMIN_GROUP_ID, text="бот поднялся", disable_notification=True
+    asyncio.create_task(Broadcaster(dp.bot, ADMIN_GROUP_ID).watch())
+
+    if WORKER_ID == 0:
+        asyncio.create_task(Geocoder().prewarm(EXAMPLE_PLACES))
+        await dp.bot.send_message(
+            chat_id=ADMIN_GROUP_ID, text="бот поднялся", disable_notification=True
+        )
+
+
+async def on_webhook_startup(dp):
+    if WORKER_ID != 0:
+        return
+
+    await register_webhook(
+        dp.bot,
+        f"{WEBHOOK_HOST}{WEBHOOK_PATH}",
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        secret_token=WEBHOOK_SECRET,
     )
 
 
 async def on_shutdown(dp):
+    await ViewsCounter().stop()
+    await UserRegistry().stop()
+    await UsageStats().stop()
+    await Geocoder().close()
+    await storage.close()
     await MongoDB().close()
-    await dp.bot.send_message(
-        chat_id=ADMIN_GROUP_ID, text="бот упал", disable_notification=True
-    )
+    if WORKER_ID == 0:
+        await dp.bot.send_message(
+            chat_id=ADMIN_GROUP_ID, text="бот упал", disable_notification=True
+        )
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from pymongo import UpdateOne
+from utils.db import MongoDB, SingletonMeta
+from utils.spatial_index import BuildingsIndex
+
+
+class ViewsCounter(metaclass=SingletonMeta):
+    """
+    Write-behind accumulator for the buildings' views counters.
+
+    A card view only bumps an in-memory delta. The shown value is the last known
+    counter plus the pending delta, and the deltas are written to MongoDB with
+    one bulk_write every flush interval and once more on shutdown.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.pending = defaultdict(int)
+        self.task = None
+
+    def start(self, interval: float):
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_periodically(interval))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def _flush_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Failed to flush views counters: {str(e)}")
+
+    def reset_counts(self, buildings: list):
+        """
+        Drop the known counters, so they are read again from the reloaded buildings,
+        which include the views flushed by the other workers.
+        """
+        self.counts = {}
+
+    async def _get_count(self, page_id):
+        if page_id in self.counts:
+            return self.counts[page_id]
+
+        building = BuildingsIndex().by_id.get(page_id)
+        if building is None:
+            collection = await MongoDB().get_collection("buildings_collection")
+            building = await collection.find_one({"id": page_id}, {"_id": 0, "views": 1})
+            if building is None:
+                return None
+
+        self.counts[page_id] = int(building.get("views", 0))
+        return self.counts[page_id]
+
+    async def increment(self, page_id):
+        """
+        Count one view of the page and return the counter to show.
+
+        Returns None if the page is unknown.
+        """
+        count = await self._get_count(page_id)
+        if count is None:
+            return None
+
+        self.pending[page_id] += 1
+        return count + self.pending[page_id]
+
+    async def flush(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, defaultdict(int)
+        operations = []
+        for page_id, delta in pending.items():
+            if page_id in self.counts:
+                self.counts[page_id] += delta
+            operations.append(UpdateOne({"id": page_id}, {"$inc": {"views": delta}}))
+
+        try:
+            collection = await MongoDB().get_collection("buildings_collection")
+            await collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logging.error(f"Failed to flush views counters: {str(e)}")
+            for page_id, delta in pending.items():
+                if page_id in self.counts:
+                    self.counts[page_id] -= delta
+                self.pending[page_id] += delta
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from typing import Optional
+
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiohttp import web
+
+UPDATES_SEMAPHORE_KEY = "UPDATES_SEMAPHORE"
+IN_FLIGHT_KEY = "IN_FLIGHT"
+SECRET_TOKEN_KEY = "SECRET_TOKEN"
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class LimitedWebhookRequestHandler(WebhookRequestHandler):
+    """
+    Webhook handler that processes at most the app's concurrency limit of
+    updates at a time. Requests beyond the limit wait for a free slot, so a
+    burst of updates queues in the web server instead of piling up handlers.
+    Requests without the secret token set in the webhook are rejected.
+    """
+
+    async def post(self):
+        secret_token = self.request.app[SECRET_TOKEN_KEY]
+        if secret_token and self.request.headers.get(SECRET_TOKEN_HEADER) != secret_token:
+            raise web.HTTPUnauthorized()
+        return await super().post()
+
+    async def process_update(self, update):
+        app = self.request.app
+        async with app[UPDATES_SEMAPHORE_KEY]:
+            app[IN_FLIGHT_KEY] += 1
+            try:
+                return await super().process_update(update)
+            finally:
+                app[IN_FLIGHT_KEY] -= 1
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok", "in_flight": request.app[IN_FLIGHT_KEY]})
+
+
+def create_web_app(concurrency: int, secret_token: Optional[str] = None) -> web.Application:
+    app = web.Application()
+    app[UPDATES_SEMAPHORE_KEY] = asyncio.Semaphore(concurrency)
+    app[IN_FLIGHT_KEY] = 0
+    app[SECRET_TOKEN_KEY] = secret_token
+    app.router.add_get("/health", health)
+    return app
+
+
+async def register_webhook(bot, url: str, max_connections: int, secret_token: Optional[str] = None):
+    """
+    Point Telegram at the webhook url unless it already is, so that several
+    workers starting together do not reset each other's webhook.
+    """
+    info = await bot.get_webhook_info()
+    if info.url == url and info.max_connections == max_connections:
+        return
+
+    await bot.set_webhook(url, max_connections=max_connections, secret_token=secret_token)
+    logging.info(f"Webhook set to {url}")